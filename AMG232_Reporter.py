@@ -17,15 +17,23 @@ class AMG232_Reporter(IonPlugin):
     depends = ["variantCaller"]
 
     def launch(self, data=None):
-        cmd = [
-            os.path.join(os.environ['DIRNAME'], 'amg232_reporter_plugin.py'),
-            '-V', self.version, 
-            'startplugin.json',
-            'barcodes.json'
-        ]
-        plugin = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=False)
-        plugin.communicate()
-        sys.exit(plugin.poll())
+        plugin_dir = os.environ['DIRNAME']
+        args = ['-V', self.version, 'startplugin.json', 'barcodes.json']
+
+        # Run the plugin in this process if we can, rather than paying for 
+        # another interpreter and Django import. Fall back to running the 
+        # script if the plugin (or Django) can't be imported here.
+        if plugin_dir not in sys.path:
+            sys.path.insert(0, plugin_dir)
+        try:
+            import django
+            import amg232_reporter_plugin
+        except ImportError as err:
+            sys.stderr.write('Can not run the plugin in-process ({}); running '
+                'it as a separate process instead.\n'.format(err))
+            cmd = [os.path.join(plugin_dir, 'amg232_reporter_plugin.py')] + args
+            sys.exit(subprocess.call(cmd, shell=False))
+        sys.exit(amg232_reporter_plugin.plugin_main(args))
 
 if __name__ == '__main__':
     PluginCLI()
@@ -13,7 +13,8 @@
 ################################################################################
 """
 Main plugin script. Relies heavily on run_amg232_reporter_pipeline.py to 
-run.
+run.  Normally run in-process by AMG232_Reporter.launch() through plugin_main(),
+but can also be run by hand from the command line.
 """
 import sys
 import os
@@ -25,18 +26,26 @@ import argparse
 import datetime
 import shutil
 import csv
-import zipfile
+import sqlite3
 
 from pprint import pprint as pp
+from contextlib import contextmanager
 
-from django.conf import settings
-from django.template.loader import render_to_string
-from django.conf import global_settings
-global_settings.LOGGING_CONFIG=None
+from sample_runner import (run_with_retries, TIMEOUT_STATUS, KILL_GRACE,
+    pipeline_stages)
+from scheduler import Scheduler, default_max_jobs
+from work_queue import WorkQueue
+from variant_store import VariantStore, default_db
+from results_writer import ResultsWriter
 
-from django import template
-register = template.Library()
-template.builtins.append(register)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+    'scripts'))
+from parse_output import Variant
+
+# Django is slow to import, so it's only set up when the first report is 
+# rendered; see setup_django().
+settings = None
+render_to_string = None
 
 # Set up some logger defaults. 
 # Min level to be reported to log. levels are 'info', 'warn', 'error', 'debug'
@@ -44,12 +53,18 @@ loglevel = 'error'
 logfile = sys.stderr
 
 plugin_params = {} # Holder for all plugin parameters
-plugin_result = {} # Holder for all plugin results
+plugin_result = {} # Holder for the summary of the plugin results
+
+# The full results for each barcode are written out as they are done, and only
+# these fields are kept in plugin_result.
+summary_fields = ('sample_name', 'result', 'num_vars', 'attempts', 
+    'results_filename', 'results_filepath', 'metrics')
+results_writer = None
 
 # Barcode summary data that is parsed by the html renderer for block report.
 barcode_summary = [] 
 
-def get_plugin_config():
+def get_plugin_config(argv=None):
     global plugin_params
 
     parser = argparse.ArgumentParser(description = __doc__)
@@ -60,7 +75,74 @@ def get_plugin_config():
     parser.add_argument('--halt', dest='halt_on_failure', action='store_true',
         help='Stop plugin if any samples fail, otherwise, just skip the failed '
            'ones.')
-    args = parser.parse_args()
+    parser.add_argument('--stream', dest='stream', action='store_true',
+        help='Run the pipeline in streaming mode, keeping the intermediate '
+            'files in a scratch dir rather than on the results volume.')
+    parser.add_argument('--no-zip', dest='make_zip', action='store_false',
+        help='Do not create a ZIP file of the intermediate VCF and Annovar '
+            'files for each sample.')
+    parser.add_argument('--zip-level', dest='zip_level', type=int, default=6,
+        choices=range(10), metavar='<0-9>',
+        help='Compression level for the intermediate files ZIP; 0 just stores '
+            'the files. DEFAULT: %(default)s')
+    parser.add_argument('--timeout', dest='timeout', type=float, default=7200,
+        metavar='<seconds>',
+        help='Kill the pipeline for a sample if it has not completed after '
+            '<seconds>. Use 0 for no limit. DEFAULT: %(default)s')
+    parser.add_argument('--stage-timeout', dest='stage_timeouts', 
+        action='append', default=[], metavar='<stage>=<seconds>',
+        help='Timeout for an individual pipeline stage (simplify, annotate, '
+            'report). Can be given more than once.')
+    parser.add_argument('--retries', dest='retries', type=int, default=1,
+        help='Number of times to retry a sample whose pipeline timed out or '
+            'was killed. DEFAULT: %(default)s')
+    parser.add_argument('--retry-delay', dest='retry_delay', type=float, 
+        default=30, metavar='<seconds>',
+        help='Seconds to wait before the first retry; doubled for each '
+            'subsequent retry. DEFAULT: %(default)s')
+    parser.add_argument('--annovar-jobs', dest='annovar_jobs', type=int,
+        default=1, metavar='<n>',
+        help='Split each sample into <n> chunks and annotate them in parallel. '
+            'Each sample then takes <n> of the server wide job slots, and <n> '
+            'is capped at --max-jobs. DEFAULT: %(default)s')
+    parser.add_argument('--max-jobs', dest='max_jobs', type=int, 
+        metavar='<n>',
+        help='Maximum number of sample pipelines allowed to run at once '
+            'across all plugin instances on this server. DEFAULT: '
+            '$AMG232_MAX_JOBS or half of the CPUs.')
+    parser.add_argument('--scheduler-dir', dest='scheduler_dir', 
+        metavar='<dir>',
+        help='Directory holding the server wide scheduler state shared by all '
+            'plugin instances.')
+    parser.add_argument('--queue-dir', dest='queue_dir', metavar='<dir>',
+        help='Distributed mode. Put the samples on a work queue in <dir>, which '
+            'must be on storage shared with the worker nodes, and wait for '
+            'the workers (`work_queue.py <dir>`) to process them.')
+    parser.add_argument('--local-workers', dest='local_workers', type=int,
+        default=1, metavar='<n>',
+        help='In distributed mode, number of workers to start on this host. '
+            'DEFAULT: %(default)s')
+    parser.add_argument('--warehouse', dest='warehouse', default=default_db,
+        metavar='<db_file>',
+        help='Variant warehouse to which the reported variants are added. Use '
+            '"" to skip. DEFAULT: %(default)s')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+        help='Read the plugin configuration and sample info, print it, and '
+            'exit without processing anything.')
+    args = parser.parse_args(argv)
+
+    # Check these here, since the pipeline failing on them for every sample is
+    # not much use.
+    for t in args.stage_timeouts:
+        try:
+            stage, seconds = t.split('=')
+            float(seconds)
+        except ValueError:
+            parser.error('Invalid stage timeout "{}". Must be in the form of '
+                '<stage>=<seconds>.'.format(t))
+        if stage not in pipeline_stages:
+            parser.error('Invalid stage "{}" in stage timeout. Choose from: '
+                '{}'.format(stage, ', '.join(pipeline_stages)))
 
     plugin_params['version'] = args.version
 
@@ -230,7 +312,7 @@ def parse_results(results_csv):
     variants = []
     with open(results_csv) as fh:
         data = csv.DictReader(fh)
-        variants = list(data)
+        variants = [Variant.from_report_row(row) for row in data]
         num_vars = len(variants)
         if num_vars == 0:
             result = 'No mutation detected.'
@@ -277,7 +359,7 @@ def safeKeys(indict):
         return indict
     # We got a dict; fix the keys and recurse to look for more dicts.
     retdict = {}
-    for key, value in indict.iteritems():
+    for key, value in indict.items():
         retdict[re.sub(r'[^0-9A-Za-z]', '_', key)] = safeKeys(value)
     return retdict
 
@@ -295,6 +377,9 @@ def updateBarcodeSummaryReport(barcode, autorefresh=False):
             barcode,
             barcode
         )
+        # No detailed report page is made for failed barcodes.
+        if barcode in plugin_params.get('failed', []):
+            details_link = barcode
         barcode_summary.append({
             'index' : len(barcode_summary),
             'barcode_name' : barcode,
@@ -331,20 +416,199 @@ def createBlockReport():
     }
     createReport(plugin_params['block_report'],'barcode_block.html', render_context)
 
-def createReport(report_name, report_template, report_data):
+def setup_django():
     """
-    Master report method. Create the desired HTML report page based on a template 
-    and some data.
+    Import and configure Django for rendering the reports, the first time that
+    it's needed.
     """
+    global settings, render_to_string
+    if render_to_string is not None:
+        return
+
+    from django.conf import settings
+    from django.template.loader import render_to_string
+    from django.conf import global_settings
+    global_settings.LOGGING_CONFIG=None
+
+    from django import template
+    register = template.Library()
+    template.builtins.append(register)
+
     if not settings.configured:
         plugin_dir = plugin_params.get('plugin_dir') or os.path.realpath(__file__)
         settings.configure(DEBUG=False, TEMPLATE_DEBUG=False, 
             INSTALLED_APPS=('django.contrib.humanize',),
             TEMPLATE_DIRS=(os.path.join(plugin_dir, 'templates'),)
         )
+
+def createReport(report_name, report_template, report_data):
+    """
+    Master report method. Create the desired HTML report page based on a template 
+    and some data.
+    """
+    setup_django()
     with open(report_name, 'w') as fh:
         fh.write(render_to_string(report_template, safeKeys(report_data)))
 
+def stage_sample(barcode, vcf):
+    """
+    Move the VCF for a barcode into its own output dir, and return the output
+    dir along with the `run_amg232_reporter_pipeline.py` command to process it.
+    """
+    plugin_result[barcode] = {}
+    sample_name = plugin_params['samples'][barcode]
+    plugin_result[barcode]['sample_name'] = sample_name
+    outdir = os.path.join(plugin_params['results_dir'], barcode)
+
+    vcf = vcf.rstrip('.gz')
+    path, vcf_file = os.path.split(vcf)
+    new_vcf = '{}_{}'.format(sample_name, vcf_file.lstrip('TSVC_variants_'))
+    new_path = os.path.join(outdir, new_vcf)
+
+    writelog('d', '\n  Pipeline Components:\n\tsample: {}\n\toutdir: {}\n\t'
+        'old path: {}\n\tnew_path: {}\n'.format(sample_name, outdir, vcf, 
+        new_path))
+
+    os.mkdir(outdir)
+    shutil.move(vcf, new_path)
+
+    cmd = [
+        os.path.join(plugin_params['plugin_dir'], 
+            'run_amg232_reporter_pipeline.py'),
+        '-g', 'TP53',
+        '-n', sample_name,
+        '-o', outdir,
+        new_path
+    ]
+    if plugin_params['config']['stream']:
+        # --scratch takes an optional dir, so keep it away from the VCF path.
+        cmd.insert(1, '--scratch')
+    if plugin_params['config']['make_zip']:
+        # The pipeline packages the intermediate files as it goes.
+        cmd[-1:-1] = [
+            '--zip', os.path.join(outdir, 
+                '{}_{}_amg232_reporter_intermediate_files.zip'.format(
+                    sample_name, barcode)),
+            '--zip-level', str(plugin_params['config']['zip_level'])
+        ]
+    for stage_timeout in plugin_params['config']['stage_timeouts']:
+        cmd[-1:-1] = ['--timeout', stage_timeout]
+    if plugin_params['config']['annovar_jobs'] > 1:
+        cmd[-1:-1] = ['--jobs', str(plugin_params['config']['annovar_jobs'])]
+    return outdir, cmd
+
+def record_failure(barcode, returncode, stderr, attempts):
+    """
+    Report an error for a sample whose pipeline failed. Return True if we were
+    asked to halt on failures.
+    """
+    sample_name = plugin_result[barcode]['sample_name']
+    writelog('e', 'Pipeline failed for sample {} after {} attempt(s). '
+        'Traced error is: '.format(sample_name, attempts))
+    writelog(None, stderr)
+    if returncode == TIMEOUT_STATUS:
+        result = 'Error: analysis timed out.'
+    else:
+        result = 'Error: analysis failed (exit status {}).'.format(returncode)
+    plugin_result[barcode]['attempts'] = attempts
+    plugin_result[barcode]['result'] = result
+    plugin_result[barcode]['num_vars'] = 'NA'
+    plugin_params['failed'].append(barcode)
+    updateBarcodeSummaryReport(barcode, True)
+    write_barcode_results(barcode)
+
+    if plugin_params['config']['halt_on_failure']:
+        writelog('e', 'Exiting as requested.')
+        return True
+    return False
+
+def report_sample(barcode, outdir, attempts):
+    """
+    Collect the pipeline results for a sample, and create the intermediate
+    files ZIP and the sample specific report page.
+    """
+    sample_name = plugin_result[barcode]['sample_name']
+    results_filename = '{}_{}_simple.amg-232_report.csv'.format(sample_name,
+        barcode)
+
+    results_filepath = os.path.join(outdir, results_filename)
+    result, num_vars, var_report = parse_results(results_filepath)
+
+    plugin_result[barcode]['attempts'] = attempts
+    plugin_result[barcode]['results_filename'] = results_filename
+    plugin_result[barcode]['results_filepath'] = results_filepath
+    plugin_result[barcode]['result'] = result
+    plugin_result[barcode]['num_vars'] = num_vars
+    plugin_result[barcode]['variant_report'] = var_report
+
+    writelog('i', '{} result: {}'.format(sample_name, result))
+    writelog('d', pp(plugin_result[barcode], stream=sys.stderr))
+
+    if plugin_params['config']['warehouse']:
+        store_variants(barcode, var_report, results_filepath)
+
+    # Pick up the pipeline metrics, including the ZIP file of intermediate
+    # files that can be used for downstream analysis and verification.
+    metrics = json_read(os.path.join(outdir, 'pipeline_metrics.json'))
+    plugin_result[barcode]['metrics'] = metrics
+    zipname = metrics.get('zip_file', '')
+    if zipname:
+        writelog('i', '{}: intermediate files packaged into {} ({} bytes).'.format(
+            sample_name, zipname, metrics['zip_bytes']))
+
+    # Create the sample specific report page
+    html_report = os.path.join(outdir, plugin_params['report_name'])
+    render_context = {
+        'variant_report' : json.dumps([v.to_dict() for v in var_report]),
+        'sample_name' : sample_name,
+        'results_file' : results_filename,
+        'vcf_data' : os.path.basename(zipname),
+    }
+
+    writelog('d', 'Creating barcode report page with the following inputs:')
+    writelog(None, 
+        '\thtml_report = {}\n\treport_data = {}\n\tCSV link:{}'.format(
+            html_report, render_context, results_filename)
+    )
+
+    createReport(html_report, 'barcode_summary.html', render_context)
+    updateBarcodeSummaryReport(barcode, True)
+    write_barcode_results(barcode)
+    writelog('i', 'Done with sample %s.' % sample_name)
+
+def write_barcode_results(barcode):
+    """
+    Write out the full results for a barcode, and only hang on to the summary 
+    so that the plugin's memory use doesn't grow with the size of the chip.
+    """
+    summary = dict((k, v) for k, v in plugin_result[barcode].items()
+        if k in summary_fields)
+    results_writer.write(barcode, plugin_result[barcode], 
+        dict((k, summary.get(k)) for k in ('sample_name', 'result', 'num_vars')))
+    plugin_result[barcode] = summary
+
+def write_results_json():
+    writelog('i', 'Writing results.json...')
+    results_writer.assemble()
+
+def store_variants(barcode, variants, source):
+    """
+    Add a barcode's reported variants to the variant warehouse. The warehouse
+    is a convenience, so don't fail the sample if we can't write to it.
+    """
+    # Use the report name, as is done when back-filling old results.
+    run = os.path.basename(plugin_params['analysis_dir'].rstrip('/')) or \
+        plugin_params['prefix']
+    try:
+        store = VariantStore(plugin_params['config']['warehouse'])
+        store.upsert(run, barcode, plugin_result[barcode]['sample_name'], 
+            variants, source)
+        store.close()
+    except (sqlite3.Error, OSError) as err:
+        # OSError if the warehouse dir can't be made.
+        writelog('w', 'Could not add {} to the variant warehouse: {}'.format(
+            barcode, err))
+
 def run_plugin():
     """
     Run the `run_amg232_pipeline.py` script on each VCF file, creating a dir of
@@ -356,118 +620,190 @@ def run_plugin():
     writelog('i', 'Processing %d barcodes...' % tot_barcodes)
     updateBarcodeSummaryReport('', True)
 
-    processed = 0
-    for barcode, vcf in sorted(plugin_params['vcfs'].items()):
-        processed += 1
-        plugin_result[barcode] = {}
-        sample_name = plugin_params['samples'][barcode]
-        plugin_result[barcode]['sample_name'] = sample_name
-        plugin_params['outdir'] = os.path.join(plugin_params['results_dir'], 
-            barcode)
-
-        vcf = vcf.rstrip('.gz')
-        path, vcf_file = os.path.split(vcf)
-        new_vcf = '{}_{}'.format(sample_name, vcf_file.lstrip('TSVC_variants_'))
-        new_path = os.path.join(plugin_params['outdir'], new_vcf)
-
-        writelog('d', '\n  Pipeline Components:\n\tsample: {}\n\toutdir: {}\n\t'
-            'old path: {}\n\tnew_path: {}\n'.format(sample_name, 
-            plugin_params['outdir'], vcf, new_path))
-    
-        os.mkdir(os.path.join(plugin_params['results_dir'], plugin_params['outdir']))
-        shutil.move(vcf, new_path)
+    # The parallel Annovar chunks for a sample each take a server wide job 
+    # slot, so there can't be more of them than there are slots.
+    max_jobs = plugin_params['config']['max_jobs'] or default_max_jobs()
+    if plugin_params['config']['annovar_jobs'] > max_jobs:
+        writelog('w', 'Only {} Annovar jobs can be run per sample with a limit '
+            'of {} jobs at once.'.format(max_jobs, max_jobs))
+        plugin_params['config']['annovar_jobs'] = max_jobs
+
+    plugin_params['failed'] = []
+    if plugin_params['config']['queue_dir']:
+        status = run_distributed()
+    else:
+        status = run_local()
+    if status:
+        return status
 
-        writelog('i', 'Start processing sample %s...' % sample_name)
-        createProgressReport('Processing sample {} of {}...'.format(
-            processed, tot_barcodes)
-        )
+    createProgressReport('Compiling barcode summary report...', True)
+    updateBarcodeSummaryReport('')
 
-        cmd = [
-            os.path.join(plugin_params['plugin_dir'], 
-                'run_amg232_reporter_pipeline.py'),
-            '-g', 'TP53',
-            '-n', sample_name,
-            '-o', plugin_params['outdir'],
-            new_path
-        ]
-        p = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        stdout, stderr = p.communicate()
-
-        # TODO: Do we want to soldier on here but report an error for a specific 
-        #       sample?  I think so, but let's get this up and running first. See
-        # 684 - 696 in sampleID_plugin.py for example. 
-        if p.returncode != 0:
-            writelog('e', 'Plugin failed during pipeline execution. Traced '
-                'error is: ')
-            writelog(None, stderr.decode('utf-8'))
+    if plugin_params['failed']:
+        writelog('w', '{} of {} barcodes failed: {}'.format(
+            len(plugin_params['failed']), tot_barcodes, 
+            ', '.join(plugin_params['failed'])))
+        # Nothing to report if every sample failed.
+        if len(plugin_params['failed']) == tot_barcodes:
             return 1
 
-        results_filename = '{}_{}_simple.amg-232_report.csv'.format(sample_name,
-            barcode)
-
-        results_filepath = os.path.join(plugin_params['outdir'], results_filename)
-        result, num_vars, var_report = parse_results(results_filepath)
-
-        plugin_result[barcode]['results_filename'] = results_filename
-        plugin_result[barcode]['results_filepath'] = results_filepath
-        plugin_result[barcode]['result'] = result
-        plugin_result[barcode]['num_vars'] = num_vars
-        plugin_result[barcode]['variant_report'] = var_report
-
-        writelog('i', '{} result: {}'.format(sample_name, result))
-        writelog('d', pp(plugin_result[barcode], stream=sys.stderr))
+def run_local():
+    """
+    Run the pipeline for each barcode in turn on this host, taking turns with
+    any other plugin instances on the server.
+    """
+    tot_barcodes = len(plugin_params['vcfs'].keys())
+    scheduler = Scheduler(plugin_params['results_dir'], 
+        state_dir=plugin_params['config']['scheduler_dir'],
+        max_jobs=plugin_params['config']['max_jobs'])
+    writelog('i', 'Server wide limit is {} concurrent sample pipelines.'.format(
+        scheduler.max_jobs))
 
-        # Create a zipfile of intermediate files that can be used for downstream
-        # analysis and verification.
-        zipname = os.path.join(plugin_params['outdir'], 
-            '{}_{}_amg232_reporter_intermediate_files.zip'.format(sample_name, 
-                barcode))
-        collect_results(plugin_params['outdir'], zipname)
+    processed = 0
+    for barcode, vcf in sorted(plugin_params['vcfs'].items()):
+        processed += 1
+        outdir, cmd = stage_sample(barcode, vcf)
+        sample_name = plugin_result[barcode]['sample_name']
+        writelog('i', 'Start processing sample %s...' % sample_name)
 
-        # Create the sample specific report page
-        html_report = os.path.join(
-            plugin_params['outdir'], 
-            plugin_params['report_name']
-        )
-        render_context = {
-            'variant_report' : plugin_result[barcode]['variant_report'],
-            'sample_name' : sample_name,
-            'results_file' : results_filename,
-            'vcf_data' : os.path.basename(zipname),
-        }
-
-        writelog('d', 'Creating barcode report page with the following inputs:')
-        writelog(None, 
-            '\thtml_report = {}\n\treport_data = {}\n\tCSV link:{}'.format(
-                html_report, render_context, results_filename)
+        # Wait for our turn in the server wide queue before running.
+        def report_queue(position, total):
+            writelog('i', 'Sample {} is number {} of {} in the server '
+                'queue.'.format(sample_name, position, total))
+            createProgressReport('Processing sample {} of {}: waiting for a '
+                'free slot (position {} of {} in the server queue)...'.format(
+                    processed, tot_barcodes, position, total))
+
+        # Take a slot for each Annovar chunk that the pipeline runs at once,
+        # only while each attempt is running.
+        @contextmanager
+        def sample_slot():
+            with scheduler.slot(barcode, on_wait=report_queue, 
+                    slots=plugin_params['config']['annovar_jobs']):
+                createProgressReport('Processing sample {} of {}...'.format(
+                    processed, tot_barcodes))
+                yield
+
+        returncode, stdout, stderr, attempts = run_with_retries(cmd, 
+            timeout=plugin_params['config']['timeout'],
+            retries=plugin_params['config']['retries'],
+            backoff=plugin_params['config']['retry_delay'],
+            logger=lambda msg: writelog('w', '{}: {}'.format(
+                sample_name, msg)),
+            slot=sample_slot
         )
 
-        createReport(html_report, 'barcode_summary.html', render_context)
-        updateBarcodeSummaryReport(barcode, True)
-        writelog('i', 'Done with sample %s.' % sample_name)
+        # Report an error for this sample, but soldier on with the rest of the
+        # barcodes unless we were asked to halt.
+        if returncode != 0:
+            if record_failure(barcode, returncode, stderr.decode('utf-8'),
+                    attempts):
+                return 1
+            continue
+        report_sample(barcode, outdir, attempts)
 
-    createProgressReport('Compiling barcode summary report...', True)
-    updateBarcodeSummaryReport('')
+def run_distributed():
+    """
+    Put a work item for each barcode on the shared work queue, optionally start
+    some workers on this host, and wait for the workers (on any node) to finish
+    them all before reporting.
+    """
+    tot_barcodes = len(plugin_params['vcfs'].keys())
+    queue = WorkQueue(plugin_params['config']['queue_dir'])
 
-def collect_results(outdir, zipname):
+    # Item names need to be unique across all of the runs using the queue.
+    run_token = '{}_{}'.format(plugin_params['prefix'], 
+        datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'))
+    items = {}
+    for barcode, vcf in sorted(plugin_params['vcfs'].items()):
+        outdir, cmd = stage_sample(barcode, vcf)
+        name = '{}.{}'.format(run_token, barcode)
+        queue.submit(name, cmd,
+            timeout=plugin_params['config']['timeout'],
+            retries=plugin_params['config']['retries'],
+            backoff=plugin_params['config']['retry_delay'],
+            run=run_token,
+            slots=plugin_params['config']['annovar_jobs'])
+        items[name] = (barcode, outdir)
+    writelog('i', 'Queued {} work items in {}.'.format(len(items), 
+        plugin_params['config']['queue_dir']))
+
+    # Our local workers only take our own items, so that they're done when 
+    # we are.
+    worker_cmd = [
+        sys.executable,
+        os.path.join(plugin_params['plugin_dir'], 'work_queue.py'),
+        '--exit-when-empty', '--poll', '2', '--run', run_token,
+    ]
+    if plugin_params['config']['max_jobs']:
+        worker_cmd += ['--max-jobs', str(plugin_params['config']['max_jobs'])]
+    if plugin_params['config']['scheduler_dir']:
+        worker_cmd += ['--scheduler-dir', plugin_params['config']['scheduler_dir']]
+    worker_cmd.append(plugin_params['config']['queue_dir'])
+    workers = []
+    for i in range(plugin_params['config']['local_workers']):
+        workers.append(subprocess.Popen(worker_cmd))
+    writelog('i', 'Started {} local workers.'.format(len(workers)))
+
+    def report_progress(done):
+        createProgressReport('Processed {} of {} samples on the work '
+            'queue...'.format(done, tot_barcodes))
+
+    # Each item is done within the time allowed for all of its attempts, so if 
+    # nothing has come back in that time (plus the lease, in case a worker 
+    # died), and no live worker is holding one of our items, there are no 
+    # workers taking our items and we stop waiting.
+    stall_timeout = None
+    if plugin_params['config']['timeout']:
+        retries = plugin_params['config']['retries']
+        stall_timeout = ((plugin_params['config']['timeout'] + KILL_GRACE) 
+            * (retries + 1) 
+            + plugin_params['config']['retry_delay'] * (2 ** retries - 1) 
+            + queue.lease)
+    results = queue.wait(items.keys(), poll=5, on_progress=report_progress,
+        stall_timeout=stall_timeout)
+
+    missing = [name for name in items if name not in results]
+    if missing:
+        writelog('e', 'No result from the work queue for {} items after {}s; '
+            'is there a worker running?'.format(len(missing), stall_timeout))
+        queue.withdraw(missing)
+        for worker in workers:
+            worker.terminate()
+    for worker in workers:
+        worker.wait()
+    queue.clear(items.keys())
+
+    for name in sorted(items, key=lambda n: items[n][0]):
+        barcode, outdir = items[name]
+        if name not in results:
+            if record_failure(barcode, TIMEOUT_STATUS, 'No worker completed '
+                    'this sample within {}s.'.format(stall_timeout), 0):
+                return 1
+            continue
+        result = results[name]
+        writelog('d', '{} was processed on {}.'.format(barcode, result['host']))
+        if result['returncode'] != 0:
+            if record_failure(barcode, result['returncode'], result['stderr'],
+                    result['attempts']):
+                return 1
+            continue
+        report_sample(barcode, outdir, result['attempts'])
+
+def plugin_main(argv=None):
     """
-    Generate a zip file of VCF and Annovar intermediate data for variant review
-    and analysis.
+    Run the plugin with the command line arguments in `argv` (DEFAULT: 
+    sys.argv), and return the exit status.
     """
-    wanted = ('annovar.txt', 'vcf')
-    manifest = [os.path.join(outdir, f) for f in os.listdir(outdir) if any(
-        f.endswith(x) for x in wanted)]
-    writelog('d', 'Files to be collected and zipped: ')
-    writelog('d', pp(manifest, stream=sys.stderr))
+    global results_writer
 
-    with zipfile.ZipFile(zipname, 'w') as zfh:
-        for f in manifest:
-            zfh.write(f, arcname=os.path.basename(f))
-    return
+    # Start from a clean slate in case we have been run before in this process.
+    plugin_params.clear()
+    plugin_result.clear()
+    del barcode_summary[:]
 
-def plugin_main():
     # Get the plugin configuration and sample info
-    get_plugin_config()
+    get_plugin_config(argv)
 
     # Write a nice start up message with some info about the config.
     writelog('i', 'AMG-232 Reporter has started')
@@ -483,32 +819,37 @@ def plugin_main():
         writelog(None, '\t{}  {}'.format(b,s))
     writelog('i', 'There are {} samples to process.'.format(
         len(plugin_params['samples'].items())))
+    if plugin_params['config']['dry_run']:
+        writelog('i', 'Dry run; not processing any samples.')
+        return 0
 
     # Figure out the latest TVC run, and get those VCFs for processing.
     plugin_out_root = os.path.dirname(plugin_params['results_dir'])
 
     # Purge any results that exist, so that we have a clean working environment!
     purge_old_results()
+    results_writer = ResultsWriter(plugin_params['results_dir'])
 
     # Collect the VCFs from TVC and stage them for processing.
     collect_vcfs(plugin_out_root)
 
-    # Start running the pipeline on our samples.
+    # Start running the pipeline on our samples. Even if we have to stop, show
+    # the errors in the block report and keep the results for the barcodes 
+    # that we managed to finish.
     if run_plugin():
+        createBlockReport()
+        write_results_json()
         return 1
 
     # Create the output HTML links and reports.
     if not 'Error' in plugin_result:
         createBlockReport()
 
-    # Write out the data to a results.json to finish up.
-    writelog('i', 'Writing results.json...')
-    jsonfile = os.path.join(plugin_params['results_dir'], 'results.json')
-    with open(jsonfile, 'w') as outfile:
-        json.dump(plugin_result, outfile, indent=4, sort_keys=True)
+    # Assemble the barcode results into a results.json to finish up.
+    write_results_json()
 
     writelog('i', 'AMG-232 Reporter has finished.\n')
     return 0
 
 if __name__ == '__main__':
-    exit(plugin_main())
+    sys.exit(plugin_main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background packager for the ZIP file of intermediate files.  Files are handed
+to the packager as soon as the pipeline stage that creates them has finished,
+and are compressed into the archive by a worker thread while the next stage
+runs.
+"""
+import os
+import queue
+import threading
+import time
+import zipfile
+
+# Inputs that are already compressed; deflating them again is wasted effort.
+compressed_exts = ('.gz', '.bgz', '.zip', '.bam')
+
+class Packager(object):
+    """
+    Add files to the ZIP file `zipname` in a background thread. `level` is the
+    deflate compression level (0-9); 0 just stores the files. The archive is
+    written to a temporary name, and only moved to `zipname` by `close()`.
+    """
+    def __init__(self, zipname, level=6):
+        self.zipname = zipname
+        self.level = level
+        self.files = 0
+        self.seconds = 0.0
+        self.error = None
+        self.closed = False
+        self._partial = zipname + '.part'
+        self._zfh = zipfile.ZipFile(self._partial, 'w')
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, path, arcname=None):
+        """
+        Queue `path` to be added to the archive. The file must not be removed
+        until `close()` has been called.
+        """
+        self._queue.put((path, arcname or os.path.basename(path)))
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            # Keep draining the queue after an error so close() doesn't hang.
+            if self.error is not None:
+                continue
+            path, arcname = item
+            start = time.time()
+            try:
+                if self.level == 0 or path.endswith(compressed_exts):
+                    self._zfh.write(path, arcname, 
+                        compress_type=zipfile.ZIP_STORED)
+                else:
+                    self._zfh.write(path, arcname, 
+                        compress_type=zipfile.ZIP_DEFLATED,
+                        compresslevel=self.level)
+            except Exception as err:
+                self.error = err
+                continue
+            self.seconds += time.time() - start
+            self.files += 1
+
+    def close(self):
+        """
+        Wait for the queued files to be written, and return some metrics about
+        the archive.
+        """
+        self._finish()
+        if self.error is not None:
+            os.remove(self._partial)
+            raise self.error
+        os.rename(self._partial, self.zipname)
+        return {
+            'zip_file' : os.path.basename(self.zipname),
+            'zip_files' : self.files,
+            'zip_bytes' : os.path.getsize(self.zipname),
+            'zip_seconds' : round(self.seconds, 3),
+            'zip_level' : self.level,
+        }
+
+    def abort(self):
+        """
+        Stop packaging and throw away the partial archive.
+        """
+        self._finish()
+        os.remove(self._partial)
+
+    def _finish(self):
+        self.closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._zfh.close()
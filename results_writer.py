@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Incremental writer for the plugin's `results.json`.  Each barcode's results are
+written to their own JSON fragment as soon as the barcode is done, along with
+an index of the barcodes written so far, so that the plugin only needs to keep
+summary data in memory and nothing is lost if the plugin dies late in a run.
+The final `results.json` is assembled by streaming the fragments, and can be
+rebuilt from them by hand with:
+
+    results_writer.py <plugin_results_dir>
+"""
+import sys
+import os
+import json
+import shutil
+import argparse
+
+version = '1.0.20181004'
+
+def get_args():
+    parser = argparse.ArgumentParser(description = __doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('results_dir', metavar='<results_dir>',
+        help='Plugin results directory holding the results fragments.')
+    parser.add_argument('-v', '--version', action='version',
+        version='%(prog)s - v' + version)
+    return parser.parse_args()
+
+def to_json(data):
+    """
+    Same layout as json.dump(..., indent=4, sort_keys=True), with any records
+    (e.g. `Variant`) converted through their `to_dict()` method.
+    """
+    return json.dumps(data, indent=4, sort_keys=True, separators=(',', ': '),
+        default=lambda obj: obj.to_dict())
+
+def write_file(text, filename):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as fh:
+        fh.write(text)
+    os.rename(tmp, filename)
+
+class ResultsWriter(object):
+    """
+    Write per-barcode results fragments under `results_dir`. Any fragments left
+    from an earlier run are removed unless `fresh` is False.
+    """
+    def __init__(self, results_dir, fresh=True):
+        self.results_dir = results_dir
+        self.fragment_dir = os.path.join(results_dir, 'results_fragments')
+        self.index_file = os.path.join(self.fragment_dir, 'index.json')
+        if fresh and os.path.isdir(self.fragment_dir):
+            shutil.rmtree(self.fragment_dir)
+        if not os.path.isdir(self.fragment_dir):
+            os.makedirs(self.fragment_dir)
+        self.index = self._read_index()
+
+    def _read_index(self):
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as fh:
+                return json.load(fh)
+        return {}
+
+    def _fragment(self, barcode):
+        return os.path.join(self.fragment_dir, barcode + '.json')
+
+    def write(self, barcode, data, summary=None):
+        """
+        Write out the full results `data` for a barcode, and record `summary`
+        (DEFAULT: nothing) for it in the index.
+        """
+        write_file(to_json(data), self._fragment(barcode))
+        self.index[barcode] = summary or {}
+        write_file(to_json(self.index), self.index_file)
+
+    def assemble(self, outfile=None):
+        """
+        Stream the fragments, in barcode order, into a single `results.json`
+        (DEFAULT: in the results dir). Return the file written.
+        """
+        outfile = outfile or os.path.join(self.results_dir, 'results.json')
+        tmp = outfile + '.tmp'
+        with open(tmp, 'w') as outfh:
+            if not self.index:
+                outfh.write('{}')
+            else:
+                outfh.write('{\n')
+                for n, barcode in enumerate(sorted(self.index)):
+                    if n:
+                        outfh.write(',\n')
+                    outfh.write('    {}: '.format(json.dumps(barcode)))
+                    with open(self._fragment(barcode)) as fh:
+                        for i, line in enumerate(fh):
+                            outfh.write(line if i == 0 else '    ' + line)
+                outfh.write('\n}')
+        os.rename(tmp, outfile)
+        return outfile
+
+if __name__ == '__main__':
+    args = get_args()
+    writer = ResultsWriter(args.results_dir, fresh=False)
+    sys.stderr.write('Wrote {}.\n'.format(writer.assemble()))
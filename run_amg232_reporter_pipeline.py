@@ -6,11 +6,21 @@ Pipeline wrapper script for the AMG-232 Reporter plugin.
 
 import sys
 import os
+import json
+import shutil
+import signal
 import subprocess
 import argparse
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
 
 from pprint import pprint as pp
 
+from packager import Packager
+from stage_graph import Stage, StageGraph, PipelineError
+from sample_runner import TIMEOUT_STATUS, pipeline_stages as stages
+
 version = '1.1.20180919'
 
 # Globals
@@ -20,8 +30,23 @@ scripts_dir = os.path.join(output_root, 'scripts')
 resources = os.path.join(output_root, 'resource')
 lib = os.path.join(output_root, 'lib')
 
+sys.path.insert(0, scripts_dir)
+from parse_output import required_protocols
+
+# Prefer a RAM backed scratch area for streaming mode so that the intermediate
+# files never touch the (often NFS mounted) results volume.
+default_scratch = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# Suffixes of the intermediate files that make up the troubleshooting ZIP.
+intermediate_files = ('annovar.txt', 'vcf')
+
 debug = True
 
+# The tools that are currently running. Each is started in its own session so
+# that a stage timeout can kill it along with its children, which means that 
+# they have to be killed by hand if the pipeline itself is terminated.
+running = set()
+
 def get_args():
     parser = argparse.ArgumentParser(description = __doc__)
     parser.add_argument('vcf', metavar="<VCF File>",
@@ -35,9 +60,46 @@ def get_args():
     parser.add_argument('-o', '--outdir', metavar='<output_directory>',
         help='Directory to which the output data should be written. DEFAULT: '
             '<sample_name>_out/')
+    parser.add_argument('-s', '--scratch', metavar='<scratch_dir>', nargs='?',
+        const=default_scratch, 
+        help='Streaming mode. Run the simplify and annotation stages in a '
+            'temporary directory under <scratch_dir> (DEFAULT: %(const)s) and '
+            'only write the final report to the output directory.')
+    parser.add_argument('-k', '--keep-intermediates', action='store_true',
+        help='When running in streaming mode, copy the intermediate VCF and '
+            'Annovar files to the output directory for further analysis.')
+    parser.add_argument('-t', '--timeout', metavar='<stage>=<seconds>',
+        action='append', default=[], 
+        help='Kill a pipeline stage if it runs longer than <seconds> and exit '
+            'with status %d. Stages are: %s. Can be given more than once.' % (
+            TIMEOUT_STATUS, ', '.join(stages)))
+    parser.add_argument('-j', '--jobs', metavar='<n>', type=int, default=1,
+        help='Split the simplified VCF into <n> chunks and annotate them in '
+            'parallel. DEFAULT: %(default)s')
+    parser.add_argument('-z', '--zip', metavar='<zip_file>',
+        help='Package the intermediate VCF and Annovar files into <zip_file> '
+            'as they are created.')
+    parser.add_argument('-Z', '--zip-level', metavar='<0-9>', type=int,
+        default=6, choices=range(10),
+        help='Compression level for the ZIP file; 0 just stores the files. '
+            'DEFAULT: %(default)s')
     parser.add_argument('-v', '--version', action='version',
         version='%(prog)s - v' + version)
     args = parser.parse_args()
+
+    timeouts = {}
+    for t in args.timeout:
+        try:
+            stage, seconds = t.split('=')
+            timeouts[stage] = float(seconds)
+        except ValueError:
+            parser.error('Invalid timeout "%s". Must be in the form of '
+                '<stage>=<seconds>.' % t)
+        if stage not in stages:
+            parser.error('Invalid stage "%s" in timeout. Choose from: %s' % (
+                stage, ', '.join(stages)))
+    args.timeout = timeouts
+
     if debug:
         sys.stderr.write('Args as passed to the script:\n')
         pp(vars(args), stream=sys.stderr)
@@ -59,72 +121,177 @@ def get_name_from_vcf(vcf):
                     name = vcf.rstrip('.vcf')
     return name
 
-def simplify_vcf(vcf, outdir):
+def simple_vcf_name(vcf, outdir):
+    return '{}_simple.vcf'.format(os.path.join(outdir, 
+        os.path.splitext(os.path.basename(vcf))[0]))
+
+def annovar_names(simple_vcf):
+    """
+    Return the (shorter and cleaner) names that we give the Annovar .txt and 
+    .vcf output files.
+    """
+    base = os.path.abspath(simple_vcf)[:-len('.vcf')]
+    return base + '.annovar.txt', base + '.annovar.vcf'
+
+def report_name(annovar_data, outdir):
+    return os.path.join(outdir, os.path.basename(annovar_data).replace(
+        'annovar.txt', 'amg-232_report.csv'))
+
+def simplify_vcf(vcf, outdir, timeout=None):
     """
     Use the `simplify_vcf.pl` script to remove reference and NOCALLs from the 
     input VCF. Return a simplified VCF containing only 1 variant per line, and 
     with only the critical VAF and coverage info.  Return the resultant simple
     VCF filename for downstream processing.
     """
-    new_name = '{}_simple.vcf'.format(os.path.join(outdir, vcf.rstrip('.vcf')))
+    new_name = simple_vcf_name(vcf, outdir)
     cmd = [os.path.join(scripts_dir, 'simplify_vcf.pl'), '-f', new_name, vcf]
-    status = run(cmd, 'simplify the Ion VCF')
+    status = run(cmd, 'simplify the Ion VCF', timeout)
     if status:
-        sys.exit(1)
-    else:
-        return new_name
+        raise PipelineError('Could not simplify the Ion VCF.', status)
+    return new_name
+
+def split_vcf(vcf, chunks):
+    """
+    Split a VCF into at most `chunks` contiguous pieces with about the same
+    number of variants each, so that concatenating the results of the pieces
+    keeps the original (genomic) order. Return the list of chunk files.
+    """
+    header = []
+    records = []
+    with open(vcf) as fh:
+        for line in fh:
+            if line.startswith('#'):
+                header.append(line)
+            else:
+                records.append(line)
+
+    chunks = max(1, min(chunks, len(records)))
+    size = -(-len(records) // chunks)
+    chunk_files = []
+    for i in range(chunks):
+        chunk_file = '{}.chunk{:03d}.vcf'.format(vcf, i)
+        with open(chunk_file, 'w') as outfh:
+            outfh.writelines(header)
+            outfh.writelines(records[i*size:(i+1)*size])
+        chunk_files.append(chunk_file)
+    return chunk_files
+
+def merge_annovar(chunk_files, outfile):
+    """
+    Concatenate the Annovar output for each chunk (in order) into `outfile`, 
+    keeping only the header from the first chunk.
+    """
+    with open(outfile, 'w') as outfh:
+        for i, chunk_file in enumerate(chunk_files):
+            with open(chunk_file) as fh:
+                for n, line in enumerate(fh):
+                    # The .txt file has a single header line, and the .vcf file
+                    # a block of '#' lines.
+                    header = line.startswith('#') or (n == 0
+                        and line.startswith('Chr\t'))
+                    if i == 0 or not header:
+                        outfh.write(line)
+
+def run_annovar_chunks(simple_vcf, jobs, timeout=None, protocols=None):
+    """
+    Annotate the simplified VCF in `jobs` chunks in parallel, and merge the 
+    results into the files Annovar would have created for the whole VCF.
+    """
+    chunk_files = split_vcf(simple_vcf, jobs)
+    with ThreadPoolExecutor(max_workers=len(chunk_files)) as pool:
+        statuses = list(pool.map(
+            lambda f: run(annovar_cmd(f, protocols), 'annotate VCF chunk %s with Annovar' 
+                % os.path.basename(f), timeout), 
+            chunk_files
+        ))
+
+    status = max(statuses)
+    if not status:
+        for ext in ('txt', 'vcf'):
+            merge_annovar(
+                ['%s.hg19_multianno.%s' % (f, ext) for f in chunk_files],
+                '%s.hg19_multianno.%s' % (simple_vcf, ext)
+            )
+
+    # Clean up so the chunks don't end up in the intermediate files.
+    for f in chunk_files:
+        for chunk_file in (f, f + '.avinput', f + '.hg19_multianno.txt', 
+                f + '.hg19_multianno.vcf'):
+            if os.path.exists(chunk_file):
+                os.remove(chunk_file)
+    return status
 
-def run_annovar(simple_vcf):
+def annovar_cmd(vcf, protocols=None):
+    """
+    Return the command to annotate `vcf` with the (protocol, operation) pairs 
+    in `protocols`, or with every protocol if none are given.
+    """
+    cmd = [os.path.join(scripts_dir, 'annovar_wrapper.sh'), vcf]
+    if protocols:
+        cmd.append(','.join(p for p, op in protocols))
+        cmd.append(','.join(op for p, op in protocols))
+    return cmd
+
+def run_annovar(simple_vcf, timeout=None, jobs=1, protocols=None):
     """
     Run Annovar on the simplified VCF to generate an annotate dataset that can
-    then be filtered by gene. Return the resultant Annovar .txt file for 
-    downstream processing.
+    then be filtered by gene. Only the `protocols` given are run. If `jobs` is
+    more than 1, split the VCF into chunks and annotate those in parallel. 
+    Return the resultant Annovar .txt file for downstream processing.
     """
-    annovar_out = ''
-    cmd = [
-        os.path.join(scripts_dir, 'annovar_wrapper.sh'), 
-        simple_vcf, 
-    ]
-    status = run(cmd, 'annotate VCF with Annovar')
-    if status:
-        sys.exit(1)
+    if jobs > 1:
+        status = run_annovar_chunks(simple_vcf, jobs, timeout, protocols)
     else:
-        # Rename the files to be shorter and cleaner
-        annovar_txt_out = os.path.abspath('%s.hg19_multianno.txt' % simple_vcf)
-        annovar_vcf_out = os.path.abspath('%s.hg19_multianno.vcf' % simple_vcf)
-        for f in (annovar_vcf_out, annovar_txt_out):
-            new_name = f.replace('vcf.hg19_multianno', 'annovar')
-            os.rename(f, new_name)
-            if new_name.endswith('txt'):
-                annovar = new_name
-        return new_name
-
-def generate_report(annovar_data, genes, outdir):
+        status = run(annovar_cmd(simple_vcf, protocols), 
+            'annotate VCF with Annovar', timeout)
+    if status:
+        raise PipelineError('Could not annotate the VCF with Annovar.', status)
+
+    # Rename the files to be shorter and cleaner
+    annovar_txt, annovar_vcf = annovar_names(simple_vcf)
+    os.rename(os.path.abspath('%s.hg19_multianno.txt' % simple_vcf), 
+        annovar_txt)
+    os.rename(os.path.abspath('%s.hg19_multianno.vcf' % simple_vcf), 
+        annovar_vcf)
+    return annovar_txt
+
+def generate_report(annovar_data, genes, outdir, timeout=None):
     """
     Process the Annovar file to filter out data by gene, population frequency, 
-    and any other filter.
+    and any other filter. Return the report CSV filename.
     """
-    new_name = annovar_data.replace('annovar.txt', 'amg-232_report.csv')
+    new_name = report_name(annovar_data, outdir)
     cmd = [
         os.path.join(scripts_dir, 'parse_output.py'),
         '-g', genes,
         '-o', new_name,
         annovar_data
     ]
-    status = run(cmd, "generate a variant report")
+    status = run(cmd, "generate a variant report", timeout)
     if status:
-        sys.exit(1)
-    else:
-        sys.stderr.write('AMG-232 Reporter completed successfully! Data can '
-            'be found in %s.\n' % outdir)
-        sys.exit()
+        raise PipelineError('Could not generate a variant report.', status)
+    return new_name
 
-def run(cmd, task):
+def run(cmd, task, timeout=None):
     """
-    Generic subprocess runner.
+    Generic subprocess runner. If `timeout` seconds pass before the command
+    completes, kill it (and its children) and return TIMEOUT_STATUS.
     """
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    msg, err = proc.communicate()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        start_new_session=True)
+    running.add(proc)
+    try:
+        msg, err = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_tool(proc)
+        proc.communicate()
+        sys.stderr.write('Timed out after %ss while trying to %s.\n' % (
+            timeout, task))
+        sys.stderr.flush()
+        return TIMEOUT_STATUS
+    finally:
+        running.discard(proc)
     # TODO: Can we / should we capture these and write them to a log file?
     # print(msg)
     if proc.returncode != 0:
@@ -134,7 +301,44 @@ def run(cmd, task):
         return 1
     return 0
 
-def main(vcf, sample_name, genes, outdir):
+def kill_tool(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def terminate(signum, frame):
+    """
+    SIGTERM handler (e.g. the plugin's sample timeout). Kill the running tools
+    and bail out through main()'s clean up, so that no tool is left running on
+    its own and the scratch dir isn't left behind.
+    """
+    for proc in list(running):
+        kill_tool(proc)
+    raise PipelineError('Pipeline terminated by signal %d.' % signum, 
+        128 + signum)
+
+def materialize_intermediates(workdir, outdir):
+    """
+    Move the intermediate VCF and Annovar files out of the streaming scratch
+    directory and into the output directory.
+    """
+    for f in os.listdir(workdir):
+        if any(f.endswith(x) for x in intermediate_files):
+            shutil.move(os.path.join(workdir, f), os.path.join(outdir, f))
+
+def write_metrics(metrics, outdir):
+    """
+    Write out some metrics about the pipeline run for the plugin to report.
+    """
+    with open(os.path.join(outdir, 'pipeline_metrics.json'), 'w') as fh:
+        json.dump(metrics, fh, indent=4, sort_keys=True)
+
+def main(vcf, sample_name, genes, outdir, scratch=None, 
+        keep_intermediates=False, timeouts=None, jobs=1, zipname=None, 
+        zip_level=6):
+    signal.signal(signal.SIGTERM, terminate)
+
     # Create an output directory based on the sample_name
     if sample_name is None:
         sample_name = get_name_from_vcf(vcf)
@@ -148,24 +352,86 @@ def main(vcf, sample_name, genes, outdir):
     if not os.path.exists(outdir_path):
         os.mkdir(os.path.abspath(outdir_path), 0o755)
 
-    # Simplify the VCF
-    # TODO: Move to a logger? Log4Python?
-    sys.stderr.write('Simplifying the VCF file.\n')
-    sys.stderr.flush()
-    simple_vcf = simplify_vcf(vcf, outdir_path)
-    #sys.stderr.write('Done!\n')
+    # In streaming mode the intermediate files live in a scratch dir, and only
+    # the final report is written to the output directory.
+    timeouts = timeouts or {}
+    workdir = outdir_path
+    if scratch is not None:
+        workdir = tempfile.mkdtemp(prefix='amg232_', dir=scratch)
+
+    simple_vcf = simple_vcf_name(vcf, workdir)
+    annovar_txt, annovar_vcf = annovar_names(simple_vcf)
+    report_csv = report_name(annovar_txt, outdir_path)
+
+    # Declare the pipeline stages. The order in which they are run follows 
+    # from their inputs and outputs. Each stage also takes the script that it
+    # runs as an input, so that it is rerun when the script changes.
+    graph = StageGraph(os.path.join(outdir_path, 'pipeline_stages.json'))
+    graph.add(Stage('simplify', 
+        lambda: simplify_vcf(vcf, workdir, timeouts.get('simplify')),
+        inputs=[vcf, os.path.join(scripts_dir, 'simplify_vcf.pl')], 
+        outputs=[simple_vcf]))
+    # Only annotate with the databases that the report filters actually use. 
+    # The annotation is out of date if that list of protocols changes.
+    protocols = required_protocols()
+    graph.add(Stage('annotate', 
+        lambda: run_annovar(simple_vcf, timeouts.get('annotate'), jobs, 
+            protocols),
+        inputs=[simple_vcf, os.path.join(scripts_dir, 'annovar_wrapper.sh')], 
+        outputs=[annovar_txt, annovar_vcf], params={'protocols' : protocols}))
+    graph.add(Stage('report',
+        lambda: generate_report(annovar_txt, genes, outdir_path, 
+            timeouts.get('report')),
+        inputs=[annovar_txt, os.path.join(scripts_dir, 'parse_output.py')], 
+        outputs=[report_csv], params={'genes' : genes}))
 
-    # Annotate the vcf with ANNOVAR.
-    sys.stderr.write('Annotating the simplified VCF with Annovar.\n')
-    sys.stderr.flush()
-    annovar_file = run_annovar(simple_vcf)
-    #sys.stderr.write('Done.\n')
+    # Package up the intermediate files in the background as each stage is
+    # done with them, and finish off the ZIP file alongside the report.
+    metrics = {'annovar_protocols' : [p for p, op in protocols]}
+    packager = None
+    if zipname is not None:
+        packager = Packager(zipname, zip_level)
+        packager.add(vcf)
+        graph.add(Stage('package', 
+            lambda: metrics.update(packager.close()),
+            inputs=[vcf, simple_vcf, annovar_txt, annovar_vcf], 
+            outputs=[zipname], params={'zip_level' : zip_level}))
 
-    # Generate a filtered CSV file of results for the report.
-    sys.stderr.write('Generating a report.\n')
-    sys.stderr.flush()
-    generate_report(annovar_file, genes, outdir_path)
+    def stage_done(stage, skipped):
+        sys.stderr.write('{} stage {}.\n'.format(stage.name.capitalize(),
+            'is up to date' if skipped else 'done'))
+        sys.stderr.flush()
+        if packager is None:
+            return
+        if stage.name == 'package' and skipped:
+            packager.abort()
+            metrics.update({
+                'zip_file' : os.path.basename(zipname),
+                'zip_bytes' : os.path.getsize(zipname),
+            })
+        elif stage.name in ('simplify', 'annotate'):
+            for f in stage.outputs:
+                packager.add(f)
+
+    try:
+        metrics.update(graph.run(on_complete=stage_done))
+        sys.stderr.write('AMG-232 Reporter completed successfully! Data can '
+            'be found in %s.\n' % outdir_path)
+    except PipelineError as err:
+        sys.stderr.write('%s\n' % err)
+        sys.exit(err.status)
+    finally:
+        # Keep whatever we managed to package if the pipeline failed.
+        if packager and not packager.closed:
+            metrics.update(packager.close())
+        write_metrics(metrics, outdir_path)
+        if workdir != outdir_path:
+            if keep_intermediates:
+                materialize_intermediates(workdir, outdir_path)
+            shutil.rmtree(workdir, ignore_errors=True)
 
 if __name__ == '__main__':
     args = get_args()
-    main(args.vcf, args.name, args.genes, args.outdir)
+    main(args.vcf, args.name, args.genes, args.outdir, args.scratch, 
+        args.keep_intermediates, args.timeout, args.jobs, args.zip, 
+        args.zip_level)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers to run the per-sample pipeline as a child process with a timeout and
+a bounded number of retries.  Kept free of any Django imports so that it can
+be used outside of the main plugin process.
+"""
+import os
+import signal
+import subprocess
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+# Exit status used (like coreutils `timeout`) when a command or one of the
+# pipeline stages ran past its allotted time.
+TIMEOUT_STATUS = 124
+
+# Pipeline stages that can be given their own timeout.
+pipeline_stages = ('simplify', 'annotate', 'report')
+
+def is_transient(returncode):
+    """
+    Timeouts and processes killed by a signal are worth another try; anything
+    else is most likely bad input data and will just fail again.
+    """
+    return returncode == TIMEOUT_STATUS or returncode < 0
+
+# Seconds that a timed out command gets to clean up (kill the tools it started
+# and remove its scratch dir) after SIGTERM, before it is sent SIGKILL.
+KILL_GRACE = 30
+
+def run_command(cmd, timeout=None, poll_interval=1, grace=KILL_GRACE):
+    """
+    Run `cmd` in its own process group. If it runs longer than `timeout` 
+    seconds, send the group SIGTERM so that the pipeline can stop the tools it
+    started and clean up, and then SIGKILL if it's still running after `grace`
+    seconds. Return the exit status, and the captured stdout and stderr.
+    """
+    # Spool the output to temp files rather than pipes so that we can poll
+    # the process without it blocking on a full pipe buffer.
+    out_fh = tempfile.TemporaryFile()
+    err_fh = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdout=out_fh, stderr=err_fh,
+        preexec_fn=os.setsid)
+
+    start = time.time()
+    returncode = None
+    try:
+        while proc.poll() is None:
+            if timeout and time.time() - start > timeout:
+                kill_group(proc, grace, poll_interval)
+                returncode = TIMEOUT_STATUS
+                break
+            time.sleep(poll_interval)
+    except BaseException:
+        # We're being shut down; don't leave the command running on its own.
+        kill_group(proc, grace, poll_interval)
+        raise
+
+    if returncode is None:
+        returncode = proc.returncode
+
+    out_fh.seek(0)
+    err_fh.seek(0)
+    stdout, stderr = out_fh.read(), err_fh.read()
+    out_fh.close()
+    err_fh.close()
+    return returncode, stdout, stderr
+
+def kill_group(proc, grace, poll_interval=1):
+    """
+    Send SIGTERM to the process group of `proc`, and SIGKILL if `proc` hasn't
+    exited after `grace` seconds.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    deadline = time.time() + grace
+    while proc.poll() is None and time.time() < deadline:
+        time.sleep(min(poll_interval, 0.1))
+    if proc.poll() is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        proc.wait()
+
+@contextmanager
+def no_slot():
+    yield
+
+def run_with_retries(cmd, timeout=None, retries=0, backoff=30, logger=None,
+        slot=None):
+    """
+    Run `cmd` through `run_command()`, retrying up to `retries` times with an
+    exponential backoff (`backoff`, 2 x `backoff`, ...) if the failure looks
+    transient.  `logger` is an optional callable taking a message string.
+    `slot` is an optional callable returning a context manager (e.g. a 
+    scheduler slot) to hold while each attempt runs, but not during the 
+    backoff. Return the exit status, stdout, stderr and the number of attempts
+    made.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        with (slot or no_slot)():
+            returncode, stdout, stderr = run_command(cmd, timeout)
+        if returncode == 0 or not is_transient(returncode) or attempt > retries:
+            return returncode, stdout, stderr, attempt
+
+        delay = backoff * 2 ** (attempt - 1)
+        if logger:
+            logger('Attempt {} failed with status {}; retrying in {}s.'.format(
+                attempt, returncode, delay))
+        time.sleep(delay)
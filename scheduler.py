@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Lightweight, server wide scheduler shared between all of the AMG-232 Reporter
+plugin instances running on a host.  There is no service to run; each plugin
+instance reads and updates a small JSON state file under an exclusive file lock
+in order to:
+
+    - cap the number of pipeline (annotation) jobs running at once across all
+      runs on the server, where a pipeline that annotates in several parallel
+      chunks takes a slot for each chunk,
+    - share the free slots fairly between runs, so that one large chip can not
+      starve a smaller one that started just after it, and
+    - report each waiting job's position in the queue.
+
+Entries left behind by plugin processes that died are cleaned up automatically.
+"""
+import os
+import errno
+import fcntl
+import json
+import socket
+import tempfile
+import time
+import multiprocessing
+
+from contextlib import contextmanager
+
+default_state_dir = os.path.join(tempfile.gettempdir(),
+    'amg232_reporter_scheduler')
+
+def default_max_jobs():
+    """
+    Allow the server admin to set the cap with an environment variable, and
+    otherwise use half of the cores on the server.
+    """
+    env = os.environ.get('AMG232_MAX_JOBS')
+    if env:
+        return int(env)
+    return max(1, multiprocessing.cpu_count() // 2)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+def job_slots(job):
+    return job.get('slots', 1)
+
+class Scheduler(object):
+    """
+    Cross process job scheduler. `run_id` identifies the plugin instance (i.e.
+    the run) and is used to share the slots fairly between runs.
+    """
+    def __init__(self, run_id, state_dir=None, max_jobs=None, poll_interval=5):
+        self.run_id = run_id
+        self.state_dir = state_dir or default_state_dir
+        self.max_jobs = max_jobs or default_max_jobs()
+        self.poll_interval = poll_interval
+        self.host = socket.gethostname()
+
+        if not os.path.isdir(self.state_dir):
+            try:
+                os.makedirs(self.state_dir)
+                os.chmod(self.state_dir, 0o777)
+            except OSError:
+                # Another plugin instance beat us to it.
+                if not os.path.isdir(self.state_dir):
+                    raise
+        self.lock_file = os.path.join(self.state_dir, 'scheduler.lock')
+        self.state_file = os.path.join(self.state_dir, 'scheduler.json')
+
+    @contextmanager
+    def _state(self):
+        """
+        Hold the scheduler lock, and yield the current state for updating. The
+        state is written back when the block completes.
+        """
+        with open(self.lock_file, 'a') as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.state_file) as fh:
+                        state = json.load(fh)
+                except (IOError, ValueError):
+                    state = {'running' : [], 'waiting' : []}
+                self._purge_dead(state)
+                yield state
+
+                tmp = self.state_file + '.tmp'
+                with open(tmp, 'w') as fh:
+                    json.dump(state, fh)
+                os.rename(tmp, self.state_file)
+            finally:
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+    def _purge_dead(self, state):
+        for queue in ('running', 'waiting'):
+            state[queue] = [job for job in state[queue]
+                if job['host'] != self.host or pid_alive(job['pid'])]
+
+    def _job_id(self, name):
+        return '{}:{}'.format(self.run_id, name)
+
+    @staticmethod
+    def fair_order(state):
+        """
+        Order the waiting jobs so that the runs take turns: each run's jobs are
+        ranked by how many slots that run already has in use plus how many of
+        its own jobs are ahead of it, with ties broken by arrival time.
+        """
+        running = {}
+        for job in state['running']:
+            running[job['run']] = running.get(job['run'], 0) + job_slots(job)
+
+        ahead = {}
+        keyed = []
+        for job in sorted(state['waiting'], key=lambda j: j['queued']):
+            rank = running.get(job['run'], 0) + ahead.get(job['run'], 0)
+            ahead[job['run']] = ahead.get(job['run'], 0) + 1
+            keyed.append((rank, job['queued'], job))
+        return [job for rank, queued, job in sorted(keyed, key=lambda k: k[:2])]
+
+    def acquire(self, name, on_wait=None, slots=1):
+        """
+        Block until `slots` slots are free for the job `name` and it is this 
+        job's turn. `on_wait` is called with the job's (1 based) queue position
+        and the total number of waiting jobs whenever that position changes.
+        A job can not take more than `max_jobs` slots.
+        """
+        job_id = self._job_id(name)
+        slots = max(1, min(slots, self.max_jobs))
+        last_position = None
+        while True:
+            with self._state() as state:
+                order = self.fair_order(state)
+                ids = [job['id'] for job in order]
+                if job_id not in ids:
+                    job = {
+                        'id' : job_id,
+                        'run' : self.run_id,
+                        'host' : self.host,
+                        'pid' : os.getpid(),
+                        'slots' : slots,
+                        'queued' : time.time(),
+                    }
+                    state['waiting'].append(job)
+                    order = self.fair_order(state)
+                    ids = [job['id'] for job in order]
+
+                # Start once the jobs up to and including this one all fit in
+                # the free slots, so that a big job isn't overtaken forever.
+                position = ids.index(job_id) + 1
+                free = self.max_jobs - sum(job_slots(j) for j in state['running'])
+                if sum(job_slots(j) for j in order[:position]) <= free:
+                    job = order[position - 1]
+                    state['waiting'].remove(job)
+                    job['started'] = time.time()
+                    state['running'].append(job)
+                    return
+                total = len(ids)
+
+            if on_wait and position != last_position:
+                on_wait(position, total)
+            last_position = position
+            time.sleep(self.poll_interval)
+
+    def release(self, name):
+        job_id = self._job_id(name)
+        with self._state() as state:
+            for queue in ('running', 'waiting'):
+                state[queue] = [job for job in state[queue]
+                    if job['id'] != job_id]
+
+    @contextmanager
+    def slot(self, name, on_wait=None, slots=1):
+        """
+        Context manager to hold `slots` slots for the job `name` while in the
+        block.
+        """
+        try:
+            self.acquire(name, on_wait, slots)
+            yield
+        finally:
+            self.release(name)
@@ -1,6 +1,6 @@
 #!/bin/bash
 # Wrapper script to launch the Annovar pipeline.
-VERSION='1.0.20180914'
+VERSION='1.1.20181004'
 
 PLUGIN_DIR=$(dirname $(readlink -f $0) | sed 's/\/scripts//')
 ANNOVAR_ROOT="${PLUGIN_DIR}/lib/annovar/"
@@ -12,11 +12,16 @@ function usage() {
     echo "$scriptname - v$VERSION"
     echo "Wrapper script to help run Annovar on VCF file."
     echo 
-    echo "USAGE: $scriptname <VCF>"
+    echo "USAGE: $scriptname <VCF> [<protocols> <operations>]"
+    echo
+    echo "Protocols and operations are comma separated lists as used by"
+    echo "table_annovar.pl. DEFAULT: all of the protocols we have databases for."
     exit
 }
 
 vcf=$1
+protocols=${2:-refGene,cosmic85,dbnsfp35a,clinvar_20170905,popfreq_all_20150413}
+operations=${3:-g,f,f,f,f}
 if [[ -z $vcf ]]; then
     echo "ERROR: you must input a VCF file!"
     exit 1
@@ -27,14 +32,17 @@ elif [[ ! -e $vcf ]]; then
     exit 1
 fi
 
+# One '-hgvs' argument per protocol.
+arguments=$(echo $protocols | sed 's/[^,]*/-hgvs/g')
+
 # Annovar cmd
 $ANNOVAR_ROOT/table_annovar.pl \
     -buildver hg19 \
     -polish \
     -remove \
     -nastring . \
-    -protocol refGene,cosmic85,dbnsfp35a,clinvar_20170905,popfreq_all_20150413 \
-    -operation g,f,f,f,f \
-    -argument '-hgvs,-hgvs,-hgvs,-hgvs,-hgvs' \
+    -protocol $protocols \
+    -operation $operations \
+    -argument $arguments \
     -vcfinput $vcf \
     $ANNOVAR_DB \
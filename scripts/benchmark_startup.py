@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure the start-up cost of the two ways of launching the plugin: running
+`amg232_reporter_plugin.py` as a new process (the command line, and the old
+launch() method), and importing it and calling plugin_main() in-process (as
+launch() does now).  The plugin is run with --dry-run, so only the imports and
+the reading of the configuration are timed.  If no startplugin.json and
+barcodes.json files are given, made up ones are used.
+"""
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import argparse
+
+from contextlib import redirect_stderr
+
+version = '1.0.20181004'
+plugin_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+plugin_script = os.path.join(plugin_dir, 'amg232_reporter_plugin.py')
+
+def get_args():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('start_plugin_json', metavar='startplugin.json',
+        nargs='?', help='Plugin start up data.')
+    parser.add_argument('barcodes_json', metavar='barcodes.json', nargs='?',
+        help='Plugin barcodes data.')
+    parser.add_argument('-b', '--barcodes', type=int, default=96, metavar='<n>',
+        help='Number of barcodes in the made up barcodes.json. DEFAULT: '
+            '%(default)s')
+    parser.add_argument('-n', '--repeat', type=int, default=5, metavar='<n>',
+        help='Number of times to run each measurement. DEFAULT: %(default)s')
+    parser.add_argument('-v', '--version', action='version',
+        version='%(prog)s - v' + version)
+    args = parser.parse_args()
+    if bool(args.start_plugin_json) != bool(args.barcodes_json):
+        parser.error('You must input both startplugin.json and barcodes.json, '
+            'or neither!')
+    return args
+
+def make_inputs(tmpdir, num_barcodes):
+    """
+    Write made up startplugin.json and barcodes.json files to `tmpdir`.
+    """
+    startplugin = {
+        'runinfo' : {
+            'analysis_dir' : tmpdir,
+            'plugin_dir' : os.path.abspath(plugin_dir),
+            'plugin_name' : 'AMG232_Reporter',
+            'results_dir' : tmpdir,
+            'url_root' : '.',
+        },
+        'expmeta' : {
+            'run_name' : 'benchmark',
+            'results_name' : 'benchmark',
+        },
+    }
+    barcodes = {}
+    for n in range(1, num_barcodes + 1):
+        barcodes['IonXpress_{:03d}'.format(n)] = {
+            'nucleotide_type' : 'DNA',
+            'sample' : 'Sample_{}'.format(n),
+        }
+
+    files = []
+    for name, data in (('startplugin.json', startplugin),
+            ('barcodes.json', barcodes)):
+        files.append(os.path.join(tmpdir, name))
+        with open(files[-1], 'w') as fh:
+            json.dump(data, fh, indent=4)
+    return files
+
+def time_cmd(cmd):
+    start = time.perf_counter()
+    subprocess.check_call(cmd, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL, cwd=plugin_dir)
+    return time.perf_counter() - start
+
+def time_import_cmd(module):
+    """
+    Return the time to import `module` in a fresh interpreter, not counting the
+    interpreter's own start up.
+    """
+    code = ('import time; start = time.perf_counter(); import {}; '
+        'print(time.perf_counter() - start)'.format(module))
+    return float(subprocess.check_output([sys.executable, '-c', code],
+        stderr=subprocess.DEVNULL, cwd=plugin_dir))
+
+def time_repeat(func, repeat):
+    return [func() for _ in range(repeat)]
+
+def main(args):
+    tmpdir = tempfile.mkdtemp(prefix='amg232_benchmark_')
+    try:
+        if args.start_plugin_json:
+            inputs = [args.start_plugin_json, args.barcodes_json]
+        else:
+            inputs = make_inputs(tmpdir, args.barcodes)
+        plugin_args = ['--dry-run'] + [os.path.abspath(f) for f in inputs]
+
+        results = []
+        results.append(('Interpreter start up', time_repeat(
+            lambda: time_cmd([sys.executable, '-c', 'pass']), args.repeat)))
+        results.append(('CLI: new process, import and config', time_repeat(
+            lambda: time_cmd([sys.executable, plugin_script] + plugin_args),
+            args.repeat)))
+        results.append(('In-process: import', time_repeat(
+            lambda: time_import_cmd('amg232_reporter_plugin'), args.repeat)))
+
+        # Run the config in this process, as launch() would, with the plugin's
+        # logging thrown away.
+        sys.path.insert(0, plugin_dir)
+        import amg232_reporter_plugin as plugin
+        with open(os.devnull, 'w') as devnull, redirect_stderr(devnull):
+            plugin.logfile = devnull
+            def run_config():
+                start = time.perf_counter()
+                plugin.plugin_main(plugin_args)
+                return time.perf_counter() - start
+            results.append(('In-process: config', time_repeat(run_config,
+                args.repeat)))
+
+        # Django is imported once either way, when the first report is made.
+        try:
+            results.append(('Django import (first report)', time_repeat(
+                lambda: time_import_cmd('django.template.loader'), args.repeat)))
+        except subprocess.CalledProcessError:
+            sys.stderr.write('Django is not available; skipping the Django '
+                'import time.\n')
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('{:40s} {:>11s} {:>11s}'.format('Measurement', 'Min (ms)',
+        'Median (ms)'))
+    for name, times in results:
+        times = sorted(times)
+        print('{:40s} {:11.1f} {:11.1f}'.format(name, times[0] * 1000,
+            times[len(times) // 2] * 1000))
+
+if __name__ == '__main__':
+    main(get_args())
@@ -15,35 +15,141 @@ version = '0.9.20180925'
 cantran_file = os.path.join(os.path.dirname(__file__), '..', 'resource', 
     'refseq.txt')
 
+# The Annovar fields read by filter_data(), and the Annovar protocol that 
+# provides each one. Only these protocols need to be run when annotating.
+filter_fields = {
+    'Func.refGene' : 'refGene',
+    'Gene.refGene' : 'refGene',
+    'GeneDetail.refGene' : 'refGene',
+    'ExonicFunc.refGene' : 'refGene',
+    'AAChange.refGene' : 'refGene',
+    'PopFreqMax' : 'popfreq_all_20150413',
+    'SIFT_pred' : 'dbnsfp35a',
+    'Polyphen2_HVAR_pred' : 'dbnsfp35a',
+}
+
+# All of the protocols that we have databases for, in the order that they are
+# run, along with the Annovar operation for each.
+annovar_protocols = (
+    ('refGene', 'g'),
+    ('cosmic85', 'f'),
+    ('dbnsfp35a', 'f'),
+    ('clinvar_20170905', 'f'),
+    ('popfreq_all_20150413', 'f'),
+)
+
 def get_args():
     parser = argparse.ArgumentParser(description = __doc__)
-    parser.add_argument('input_file', help='Data file to parse')
+    parser.add_argument('input_file', nargs='?', help='Data file to parse')
     parser.add_argument('-g', '--gene', metavar="<gene>", default='TP53',
         help='Gene (or comma separated list of genes) on which to filter the '
         'data. If you want to get the output for every gene in the file, use '
         '"all". DEFAULT: %(default)s')
     parser.add_argument('-o', '--outfile', metavar='<output_file>',
         help='File to which the output should be written.')
+    parser.add_argument('-p', '--protocols', action='store_true',
+        help='Print the Annovar protocols needed for the fields that are '
+        'filtered on, and exit.')
     parser.add_argument('-v', '--version', action='version', 
         version = '%(prog)s - v' + version)
     args = parser.parse_args()
+    if not args.input_file and not args.protocols:
+        parser.error('You must input a data file to parse!')
     return args
 
+class Variant(object):
+    """
+    Compact record for a reported variant, used from parsing the Annovar data
+    through to the plugin's report and results. The position, VAF and 
+    population frequency are converted to numbers once, here, for filtering
+    and the warehouse; the report and results get the VAF text as it was read
+    (e.g. '50.00' from simplify_vcf.pl).
+    """
+    # Record fields, and the matching report CSV column names.
+    __slots__ = ('chr', 'pos', 'ref', 'alt', 'vaf', 'gene', 'transcript', 
+        'cds', 'aa', 'function', 'sift', 'polyphen', 'popfreq', 'vaf_text')
+    columns = ('Chr', 'Pos', 'Ref', 'Alt', 'VAF', 'Gene', 'Transcript', 'CDS', 
+        'AA', 'Function', 'SIFT', 'Polyphen')
+
+    def __init__(self, chr, pos, ref, alt, vaf, gene, transcript, cds, aa, 
+            function, sift, polyphen, popfreq=None):
+        self.chr = chr
+        self.pos = int(pos)
+        self.ref = ref
+        self.alt = alt
+        self.vaf = to_float(vaf)
+        self.vaf_text = vaf if vaf is not None else '.'
+        self.gene = gene
+        self.transcript = transcript
+        self.cds = cds
+        self.aa = aa
+        self.function = function
+        self.sift = sift
+        self.polyphen = polyphen
+        self.popfreq = to_float(popfreq)
+
+    def __repr__(self):
+        return 'Variant({}:{} {}>{} {} {})'.format(self.chr, self.pos, self.ref,
+            self.alt, self.gene, self.aa)
+
+    @classmethod
+    def from_report_row(cls, row):
+        """
+        Create a record from a report CSV row (as read by csv.DictReader).
+        """
+        return cls(*[row[c] for c in cls.columns])
+
+    def report_row(self):
+        row = [getattr(self, f) for f in self.__slots__[:len(self.columns)]]
+        row[1] = str(self.pos)
+        row[4] = str(self.vaf_text)
+        return row
+
+    def to_dict(self):
+        """
+        Return the record keyed on the report column names, for rendering and 
+        JSON output.
+        """
+        return dict(zip(self.columns, self.report_row()))
+
+def to_float(value):
+    """
+    Annovar uses '.' for missing values; return None for those.
+    """
+    if value is None or value in ('.', ''):
+        return None
+    return float(value)
+
+def required_protocols(fields=None):
+    """
+    Return a list of (protocol, operation) tuples for the Annovar protocols 
+    needed to provide `fields` (DEFAULT: the fields used by filter_data()).
+    """
+    wanted = set(filter_fields[f] for f in (fields or filter_fields))
+    return [p for p in annovar_protocols if p[0] in wanted]
+
 def read_file(input_file):
     """
-    Read the Annovar input file into a dict. We want to have some of the VCF
-    information that was included in the Annovar output's "Otherinfo" column,
-    but there are no headers for this in the file.  So, first fix the header 
-    elems, and then read into a dict like normal.
+    Read the Annovar input file, yielding a dict for each variant. We want to
+    have some of the VCF information that was included in the Annovar output's
+    "Otherinfo" column, but there are no headers for this in the file.  So, 
+    first fix the header elems, and then read just the columns that we need.
     """
     added_elems = ['field1', 'field2', 'field3', 'vcf_chr', 'vcf_pos', 
         'vcf_varid', 'vcf_ref', 'vcf_alt', 'vcf_qual', 'vcf_filter', 'vcf_info',
         'vcf_format', 'vcf_data']
     with open(input_file) as fh:
         header = fh.readline().split('\t')
-        header = header[:105] + added_elems
-        data = [dict(zip(header, line.split('\t'))) for line in fh]
-    return data
+        # Where the Otherinfo columns start depends on the protocols run.
+        otherinfo = next(i for i, h in enumerate(header) 
+            if h.startswith('Otherinfo'))
+        header = header[:otherinfo] + added_elems
+
+        wanted = ['Chr', 'Start', 'Ref', 'Alt', 'vcf_info'] + list(filter_fields)
+        index = [(col, header.index(col)) for col in wanted]
+        for line in fh:
+            fields = line.split('\t')
+            yield dict((col, fields[i]) for col, i in index)
 
 def filter_data(data, genes, cantran):
     results = []
@@ -65,8 +171,10 @@ def filter_data(data, genes, cantran):
         # Filter out Intronic variants
         elif var['AAChange.refGene'] == '.' and var['GeneDetail.refGene'] == '.':
             continue
+
         # Filter by maximum population frequency (combined ExAC, 1000G and dbSNP)
-        elif var['PopFreqMax'] != '.' and float(var['PopFreqMax']) > 0.01:
+        popfreq = to_float(var['PopFreqMax'])
+        if popfreq is not None and popfreq > 0.01:
             continue
 
         # The way that Annovar does this is to have the transcript, CDS, etc. in 
@@ -109,21 +217,12 @@ def filter_data(data, genes, cantran):
         # Add in the VAF data
         # TODO:
         vaf = get_vaf(var['vcf_info'])
-        if float(vaf) < 5:
+        if to_float(vaf) < 5:
             continue
 
-
-        wanted_data = {k : var[k] for k in ('Chr', 'Start', 'Ref', 'Alt', 
-            'ExonicFunc.refGene', 'Gene.refGene')}
-        wanted_data.update({
-            'vaf' : vaf,
-            'transcript' : transcript, 
-            'cds' : cds, 
-            'aa' : aa,
-            'polyphen' : polyphen_score,
-            'sift' : sift_score
-        })
-        results.append(wanted_data)
+        results.append(Variant(var['Chr'], var['Start'], var['Ref'], 
+            var['Alt'], vaf, var['Gene.refGene'], transcript, cds, aa, 
+            var['ExonicFunc.refGene'], sift_score, polyphen_score, popfreq))
     return results
 
 def get_vaf(data):
@@ -187,13 +286,9 @@ def print_results(results, outfile):
     else:
         outfh = sys.stdout
     csv_writer = csv.writer(outfh, lineterminator="\n", delimiter=",")
-    wanted = ('Chr', 'Start', 'Ref', 'Alt', 'vaf', 'Gene.refGene', 
-        'transcript', 'cds', 'aa', 'ExonicFunc.refGene', 'sift', 'polyphen')
-
-    csv_writer.writerow(('Chr', 'Pos', 'Ref', 'Alt', 'VAF', 'Gene', 
-        'Transcript', 'CDS', 'AA', 'Function', 'SIFT', 'Polyphen'))
+    csv_writer.writerow(Variant.columns)
     for var in results:
-        csv_writer.writerow([var.get(x) for x in wanted])
+        csv_writer.writerow(var.report_row())
 
 def main(input_file, genes, outfile):
     transcripts = read_cantran(cantran_file)
@@ -203,6 +298,9 @@ def main(input_file, genes, outfile):
 
 if __name__ == '__main__':
     args = get_args()
+    if args.protocols:
+        print(','.join(p for p, op in required_protocols()))
+        sys.exit()
     if args.gene == 'all':
         genes = []
     else:
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Small declarative stage graph executor for the AMG-232 Reporter pipeline.
+
+Each stage declares the files it reads and the files it writes, and the
+dependencies between stages follow from those: a stage runs after the stages
+that make its inputs.  Stages whose inputs, outputs and parameters have not
+changed (by content hash) since the last successful run are skipped, and stages
+that don't depend on each other are run in parallel.
+"""
+import os
+import json
+import hashlib
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class PipelineError(Exception):
+    """
+    Raised by a stage that failed. `status` is the exit status to use for the
+    pipeline.
+    """
+    def __init__(self, msg, status=1):
+        super(PipelineError, self).__init__(msg)
+        self.status = status
+
+class Stage(object):
+    """
+    A pipeline stage. `func` is called with no arguments and must create all of
+    the `outputs`. `params` holds any (JSON serializable) settings, other than
+    the inputs, that change what the stage makes.
+    """
+    def __init__(self, name, func, inputs=(), outputs=(), params=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params
+
+def params_hash(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode(
+        'utf-8')).hexdigest()
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+class StageGraph(object):
+    """
+    Collection of stages to run. Hashes of each stage's inputs and outputs are
+    recorded in `stamp_file` so that up to date stages can be skipped next time.
+    """
+    def __init__(self, stamp_file=None, jobs=2):
+        self.stamp_file = stamp_file
+        self.jobs = jobs
+        self.stages = []
+
+    def add(self, stage):
+        self.stages.append(stage)
+        return stage
+
+    def dependencies(self, stage):
+        """
+        Return the names of the stages that make the inputs for `stage`.
+        """
+        producers = {}
+        for s in self.stages:
+            for output in s.outputs:
+                producers[output] = s.name
+        return set(producers[i] for i in stage.inputs if i in producers)
+
+    def _read_stamps(self):
+        if self.stamp_file and os.path.exists(self.stamp_file):
+            with open(self.stamp_file) as fh:
+                return json.load(fh)
+        return {}
+
+    def _write_stamps(self, stamps):
+        if self.stamp_file:
+            with open(self.stamp_file, 'w') as fh:
+                json.dump(stamps, fh, indent=4, sort_keys=True)
+
+    def _stamp(self, stage):
+        return {
+            'inputs' : dict((f, file_hash(f)) for f in stage.inputs),
+            'outputs' : dict((f, file_hash(f)) for f in stage.outputs),
+            'params' : params_hash(stage.params),
+        }
+
+    def up_to_date(self, stage, stamps):
+        if stage.name not in stamps or not stage.outputs:
+            return False
+        if not all(os.path.exists(f) for f in stage.outputs):
+            return False
+        return self._stamp(stage) == stamps[stage.name]
+
+    def run(self, on_complete=None):
+        """
+        Run the stages, in parallel where possible. `on_complete` is called
+        with each stage, and whether it was skipped, once it is done. Return a
+        dict of metrics. The first stage failure is re-raised once the other
+        running stages have finished.
+        """
+        deps = dict((s.name, self.dependencies(s)) for s in self.stages)
+        pending = list(self.stages)
+        done = set()
+        running = {}
+        stamps = self._read_stamps()
+        metrics = {'stage_seconds' : {}, 'skipped_stages' : []}
+        error = None
+
+        def execute(stage):
+            start = time.time()
+            stage.func()
+            return time.time() - start
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while pending or running:
+                # Start (or skip) everything whose dependencies are done.
+                skipped = False
+                for stage in list(pending):
+                    if error is not None or not deps[stage.name] <= done:
+                        continue
+                    pending.remove(stage)
+                    if self.up_to_date(stage, stamps):
+                        skipped = True
+                        done.add(stage.name)
+                        metrics['skipped_stages'].append(stage.name)
+                        if on_complete:
+                            on_complete(stage, True)
+                    else:
+                        running[pool.submit(execute, stage)] = stage
+                if not running:
+                    if error is not None or not pending:
+                        break
+                    elif not skipped:
+                        raise PipelineError('Can not resolve the inputs of '
+                            'stages: {}'.format(
+                                ', '.join(s.name for s in pending)))
+                    continue
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    try:
+                        metrics['stage_seconds'][stage.name] = round(
+                            future.result(), 3)
+                    except Exception as err:
+                        stamps.pop(stage.name, None)
+                        if error is None:
+                            error = err
+                        continue
+                    stamps[stage.name] = self._stamp(stage)
+                    done.add(stage.name)
+                    if on_complete:
+                        on_complete(stage, False)
+
+        self._write_stamps(stamps)
+        if error is not None:
+            raise error
+        return metrics
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local, indexed warehouse of the variants reported by the AMG-232 Reporter
+across runs.  The plugin adds each barcode's filtered variants as it finishes,
+and the data can then be queried from the command line, e.g.:
+
+    variant_store.py query -g TP53 -a p.R175H --summary
+
+Results from older plugin runs can be loaded with:
+
+    variant_store.py backfill /results/analysis/output/Home/
+"""
+import sys
+import os
+import csv
+import sqlite3
+import datetime
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+    'scripts'))
+from parse_output import Variant
+
+version = '1.0.20181003'
+
+def default_db_file():
+    """
+    Keep the warehouse outside of the plugin dir, so that it survives the 
+    plugin being reinstalled or upgraded. The location can be set with an
+    environment variable, and otherwise it goes in the Torrent Suite plugin 
+    scratch area (or the user's home dir if there isn't one).
+    """
+    env = os.environ.get('AMG232_WAREHOUSE')
+    if env:
+        return env
+    if os.path.isdir('/results/plugins/scratch'):
+        warehouse_dir = '/results/plugins/scratch/AMG232_Reporter'
+    else:
+        warehouse_dir = os.path.join(os.path.expanduser('~'), '.amg232_reporter')
+    return os.path.join(warehouse_dir, 'variant_warehouse.db')
+
+default_db = default_db_file()
+report_suffix = 'amg-232_report.csv'
+
+schema = '''
+CREATE TABLE IF NOT EXISTS variants (
+    run TEXT NOT NULL,
+    barcode TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    chr TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    ref TEXT NOT NULL,
+    alt TEXT NOT NULL,
+    vaf REAL,
+    gene TEXT,
+    transcript TEXT,
+    cds TEXT,
+    aa TEXT,
+    function TEXT,
+    sift TEXT,
+    polyphen TEXT,
+    source TEXT,
+    loaded TEXT,
+    PRIMARY KEY (run, barcode, chr, pos, ref, alt)
+);
+CREATE INDEX IF NOT EXISTS variants_gene ON variants (gene, aa);
+CREATE INDEX IF NOT EXISTS variants_position ON variants (chr, pos, ref, alt);
+CREATE INDEX IF NOT EXISTS variants_sample ON variants (sample);
+CREATE INDEX IF NOT EXISTS variants_aa ON variants (aa);
+CREATE INDEX IF NOT EXISTS variants_cds ON variants (cds);
+'''
+
+# Warehouse columns holding the reported variant fields.
+variant_columns = ('chr', 'pos', 'ref', 'alt', 'vaf', 'gene', 'transcript', 
+    'cds', 'aa', 'function', 'sift', 'polyphen')
+
+def get_args():
+    parser = argparse.ArgumentParser(description = __doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-d', '--db', metavar='<db_file>', default=default_db,
+        help='Warehouse database file. DEFAULT: %(default)s')
+    parser.add_argument('-v', '--version', action='version',
+        version='%(prog)s - v' + version)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    query = subparsers.add_parser('query', help='Find reported variants.')
+    query.add_argument('-g', '--gene', metavar='<gene>', help='Gene name.')
+    query.add_argument('-p', '--position', metavar='<chr:pos>',
+        help='Genomic position (hg19), e.g. chr17:7578406.')
+    query.add_argument('-a', '--allele', metavar='<allele>',
+        help='Variant allele, as either the HGVS AA or CDS change (e.g. '
+            'p.R175H, c.524G>A), or the ref>alt change at a --position.')
+    query.add_argument('-s', '--sample', metavar='<sample>',
+        help='Sample name.')
+    query.add_argument('-r', '--run', metavar='<run>', help='Run name.')
+    query.add_argument('--summary', action='store_true',
+        help='Report the number of samples each variant was seen in, along '
+            'with the sample names, rather than every observation.')
+
+    backfill = subparsers.add_parser('backfill',
+        help='Load the results of existing plugin runs.')
+    backfill.add_argument('paths', metavar='<path>', nargs='+',
+        help='Directories to search for *%s files.' % report_suffix)
+    return parser.parse_args()
+
+class VariantStore(object):
+    """
+    SQLite backed variant warehouse.
+    """
+    def __init__(self, db_file=None):
+        self.db_file = db_file or default_db
+        db_dir = os.path.dirname(os.path.abspath(self.db_file))
+        if not os.path.isdir(db_dir):
+            try:
+                os.makedirs(db_dir)
+            except OSError:
+                # Another plugin instance beat us to it.
+                if not os.path.isdir(db_dir):
+                    raise
+        # Other plugin instances may be writing at the same time, so be willing
+        # to wait a while for the lock.
+        self.conn = sqlite3.connect(self.db_file, timeout=60)
+        self.conn.executescript(schema)
+
+    def close(self):
+        self.conn.close()
+
+    def upsert(self, run, barcode, sample, variants, source=None):
+        """
+        Replace the variants stored for a run's barcode with `variants`, a list
+        of `Variant` records.
+        """
+        loaded = datetime.datetime.now().isoformat()
+        rows = []
+        for var in variants:
+            row = dict((col, getattr(var, col)) for col in variant_columns)
+            row.update({
+                'run' : run,
+                'barcode' : barcode,
+                'sample' : sample,
+                'source' : source,
+                'loaded' : loaded,
+            })
+            rows.append(row)
+
+        columns = ['run', 'barcode', 'sample'] + list(variant_columns) + [
+            'source', 'loaded']
+        with self.conn:
+            self.conn.execute('DELETE FROM variants WHERE run = ? AND '
+                'barcode = ?', (run, barcode))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO variants ({}) VALUES ({})'.format(
+                    ', '.join(columns), ', '.join(':' + c for c in columns)),
+                rows
+            )
+        return len(rows)
+
+    def query(self, gene=None, position=None, allele=None, sample=None,
+            run=None, summary=False):
+        """
+        Return the header and rows of the variants matching all of the given
+        criteria.
+        """
+        where = []
+        params = []
+        if gene:
+            where.append('gene = ?')
+            params.append(gene)
+        if position:
+            chrom, pos = position.split(':')
+            if not chrom.startswith('chr'):
+                chrom = 'chr' + chrom
+            where.append('chr = ? AND pos = ?')
+            params.extend([chrom, int(pos)])
+        if allele:
+            if '>' in allele and not allele.startswith('c.'):
+                ref, alt = allele.split('>')
+                where.append('ref = ? AND alt = ?')
+                params.extend([ref, alt])
+            else:
+                where.append('(aa = ? OR cds = ?)')
+                params.extend([allele, allele])
+        if sample:
+            where.append('sample = ?')
+            params.append(sample)
+        if run:
+            where.append('run = ?')
+            params.append(run)
+        where_clause = ' WHERE ' + ' AND '.join(where) if where else ''
+
+        if summary:
+            header = ['chr', 'pos', 'ref', 'alt', 'gene', 'cds', 'aa',
+                'num_samples', 'samples']
+            sql = ('SELECT chr, pos, ref, alt, gene, cds, aa, '
+                'COUNT(DISTINCT sample), GROUP_CONCAT(DISTINCT sample) '
+                'FROM variants{} GROUP BY chr, pos, ref, alt '
+                'ORDER BY COUNT(DISTINCT sample) DESC, chr, pos'.format(
+                    where_clause))
+        else:
+            header = ['run', 'barcode', 'sample'] + list(variant_columns)
+            sql = 'SELECT {} FROM variants{} ORDER BY chr, pos, run, barcode'.format(
+                ', '.join(header), where_clause)
+        return header, self.conn.execute(sql, params).fetchall()
+
+def parse_report_path(report):
+    """
+    Work out the run, barcode and sample for a plugin report CSV from its path,
+    which looks like:
+
+        <report_dir>/plugin_out/<plugin_out_dir>/<barcode>/<sample>_<barcode>_simple.amg-232_report.csv
+    """
+    barcode_dir = os.path.dirname(os.path.abspath(report))
+    barcode = os.path.basename(barcode_dir)
+    plugin_out_dir = os.path.dirname(barcode_dir)
+    if os.path.basename(os.path.dirname(plugin_out_dir)) == 'plugin_out':
+        run = os.path.basename(os.path.dirname(os.path.dirname(plugin_out_dir)))
+    else:
+        run = os.path.basename(plugin_out_dir)
+
+    sample = os.path.basename(report)
+    suffix = '_{}_simple.{}'.format(barcode, report_suffix)
+    if sample.endswith(suffix):
+        sample = sample[:-len(suffix)]
+    else:
+        sample = sample.split('_simple.')[0]
+    return run, barcode, sample
+
+def backfill(store, paths):
+    """
+    Load every plugin report CSV found under `paths` into the warehouse.
+    """
+    total = 0
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                if not f.endswith(report_suffix):
+                    continue
+                report = os.path.join(root, f)
+                run, barcode, sample = parse_report_path(report)
+                with open(report) as fh:
+                    variants = [Variant.from_report_row(row) 
+                        for row in csv.DictReader(fh)]
+                total += store.upsert(run, barcode, sample, variants, report)
+                sys.stderr.write('Loaded {} variants for {} ({}) from run '
+                    '{}.\n'.format(len(variants), sample, barcode, run))
+    sys.stderr.write('Loaded {} variants in total.\n'.format(total))
+
+def main(args):
+    store = VariantStore(args.db)
+    if args.command == 'backfill':
+        backfill(store, args.paths)
+    else:
+        header, rows = store.query(args.gene, args.position, args.allele,
+            args.sample, args.run, args.summary)
+        csv_writer = csv.writer(sys.stdout, lineterminator="\n", delimiter=",")
+        csv_writer.writerow(header)
+        csv_writer.writerows(rows)
+    store.close()
+
+if __name__ == '__main__':
+    main(get_args())
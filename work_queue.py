@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Shared filesystem work queue used to spread the per-sample pipelines of a run
+over several analysis nodes that mount the same results volume.
+
+The coordinating plugin writes one JSON work item per barcode into the
+`pending/` dir of the queue. Workers, started on any node with access to the
+queue (and to the same plugin installation path), claim an item by renaming it
+into `claimed/` (an atomic operation, so only one worker can win), run the
+pipeline command in a slot from the node's own server wide scheduler (see 
+`scheduler.py`), and write the outcome into `done/`. While an item is being
+worked on, its claimed file is touched regularly; the coordinator puts items
+whose claim has gone stale (e.g. the node died) back into `pending/`.
+
+To run a worker:
+
+    work_queue.py <queue_dir>
+
+Several workers can be run on one machine to test things locally.
+"""
+import sys
+import os
+import errno
+import json
+import signal
+import socket
+import threading
+import time
+import argparse
+
+from sample_runner import run_with_retries
+from scheduler import Scheduler
+
+version = '1.0.20181003'
+
+def get_args():
+    parser = argparse.ArgumentParser(description = __doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('queue_dir', metavar='<queue_dir>',
+        help='Shared work queue directory to take items from.')
+    parser.add_argument('-e', '--exit-when-empty', action='store_true',
+        help='Exit once there are no pending items, rather than waiting for '
+            'more to arrive.')
+    parser.add_argument('-p', '--poll', type=float, default=10,
+        metavar='<seconds>',
+        help='How often to check the queue for new items. DEFAULT: '
+            '%(default)s')
+    parser.add_argument('-r', '--run', metavar='<run>',
+        help='Only take the items of this run (i.e. items named <run>.*).')
+    parser.add_argument('-m', '--max-jobs', type=int, metavar='<n>',
+        help='Maximum number of sample pipelines allowed to run at once on '
+            'this node. DEFAULT: $AMG232_MAX_JOBS or half of the CPUs.')
+    parser.add_argument('-s', '--scheduler-dir', metavar='<dir>',
+        help='Directory holding the scheduler state for this node.')
+    parser.add_argument('-v', '--version', action='version',
+        version='%(prog)s - v' + version)
+    return parser.parse_args()
+
+def write_json(data, filename):
+    """
+    Write a JSON file such that readers on other nodes never see it partially
+    written.
+    """
+    tmp = '{}.{}.{}.tmp'.format(filename, socket.gethostname(), os.getpid())
+    with open(tmp, 'w') as fh:
+        json.dump(data, fh)
+    os.rename(tmp, filename)
+
+def read_json(filename):
+    with open(filename) as fh:
+        return json.load(fh)
+
+class WorkQueue(object):
+    """
+    A work queue rooted at `queue_dir`, which must be on storage shared by the
+    coordinator and all of the workers.
+    """
+    def __init__(self, queue_dir, lease=300):
+        self.queue_dir = queue_dir
+        self.lease = lease
+        self.dirs = {}
+        for d in ('pending', 'claimed', 'done'):
+            self.dirs[d] = os.path.join(queue_dir, d)
+            if not os.path.isdir(self.dirs[d]):
+                try:
+                    os.makedirs(self.dirs[d])
+                except OSError:
+                    if not os.path.isdir(self.dirs[d]):
+                        raise
+
+    def _path(self, state, name):
+        return os.path.join(self.dirs[state], name + '.json')
+
+    def submit(self, name, cmd, timeout=None, retries=0, backoff=30, run=None,
+            slots=1):
+        """
+        Add a work item to run `cmd`. `name` must be unique within the queue.
+        `run` (DEFAULT: `name`) is used to share the scheduler slots on each
+        node fairly between runs, and `slots` is the number of slots that the
+        item takes.
+        """
+        item = {
+            'name' : name,
+            'run' : run or name,
+            'slots' : slots,
+            'cmd' : cmd,
+            'timeout' : timeout,
+            'retries' : retries,
+            'backoff' : backoff,
+        }
+        # Clear out any stale result from an earlier attempt with this name.
+        try:
+            os.remove(self._path('done', name))
+        except OSError:
+            pass
+        write_json(item, self._path('pending', name))
+
+    def claim(self, run=None):
+        """
+        Try to claim the next pending item, only looking at the items of `run`
+        (those named `<run>.*`) if given. Return the item, or None if there is
+        nothing left to claim.
+        """
+        for f in sorted(os.listdir(self.dirs['pending'])):
+            if not f.endswith('.json'):
+                continue
+            if run and not f.startswith(run + '.'):
+                continue
+            name = f[:-len('.json')]
+            try:
+                os.rename(self._path('pending', name),
+                    self._path('claimed', name))
+            except OSError:
+                # Another worker got there first.
+                continue
+            # Start the lease from the time of the claim.
+            os.utime(self._path('claimed', name), None)
+            return read_json(self._path('claimed', name))
+        return None
+
+    def complete(self, item, returncode, stdout, stderr, attempts):
+        result = dict(item)
+        result.update({
+            'returncode' : returncode,
+            'stdout' : stdout,
+            'stderr' : stderr,
+            'attempts' : attempts,
+            'host' : socket.gethostname(),
+            'pid' : os.getpid(),
+        })
+        write_json(result, self._path('done', item['name']))
+        try:
+            os.remove(self._path('claimed', item['name']))
+        except OSError as err:
+            # Coordinator may have requeued us if we missed our heartbeat.
+            if err.errno != errno.ENOENT:
+                raise
+
+    def heartbeat(self, name):
+        try:
+            os.utime(self._path('claimed', name), None)
+        except OSError:
+            pass
+
+    def requeue_stale(self):
+        """
+        Put items whose worker has stopped sending heartbeats back in the
+        pending queue. Return the names of the requeued items.
+        """
+        requeued = []
+        now = time.time()
+        for f in os.listdir(self.dirs['claimed']):
+            if not f.endswith('.json'):
+                continue
+            name = f[:-len('.json')]
+            try:
+                if now - os.path.getmtime(self._path('claimed', name)) > self.lease:
+                    os.rename(self._path('claimed', name),
+                        self._path('pending', name))
+                    requeued.append(name)
+            except OSError:
+                # Finished or requeued in the meantime.
+                continue
+        return requeued
+
+    def results(self, names):
+        """
+        Return a dict of the results that are available for the items in
+        `names`.
+        """
+        results = {}
+        for name in names:
+            try:
+                results[name] = read_json(self._path('done', name))
+            except (IOError, OSError, ValueError):
+                continue
+        return results
+
+    def active(self, names):
+        """
+        Return the names of the items in `names` that are claimed by a worker
+        that is still sending heartbeats.
+        """
+        active = []
+        now = time.time()
+        for name in names:
+            try:
+                if now - os.path.getmtime(self._path('claimed', name)) <= self.lease:
+                    active.append(name)
+            except OSError:
+                continue
+        return active
+
+    def withdraw(self, names):
+        """
+        Take the items in `names` off the queue, so that no worker will start
+        them. A worker that is already running one will still finish it.
+        """
+        for name in names:
+            for state in ('pending', 'claimed'):
+                try:
+                    os.remove(self._path(state, name))
+                except OSError:
+                    pass
+
+    def clear(self, names):
+        """
+        Remove the results of the items in `names` from the queue.
+        """
+        for name in names:
+            try:
+                os.remove(self._path('done', name))
+            except OSError:
+                pass
+
+    def wait(self, names, poll=10, on_progress=None, stall_timeout=None):
+        """
+        Block until all of the items in `names` are done, requeueing any stale
+        claims along the way. `on_progress` is called with the number of
+        completed items whenever that changes. If no item is completed for 
+        `stall_timeout` seconds (e.g. there are no live workers), give up 
+        waiting. A live worker holding one of the items (e.g. waiting for a 
+        scheduler slot on its node) counts as progress. Return the results 
+        that are available.
+        """
+        names = set(names)
+        last_done = None
+        last_change = time.time()
+        while True:
+            results = self.results(names)
+            if len(results) != last_done:
+                last_change = time.time()
+                if on_progress:
+                    on_progress(len(results))
+            last_done = len(results)
+            if len(results) == len(names):
+                return results
+            if self.active(names):
+                last_change = time.time()
+            if stall_timeout and time.time() - last_change > stall_timeout:
+                return results
+            self.requeue_stale()
+            time.sleep(poll)
+
+def decode(data):
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+    return data
+
+def terminate(signum, frame):
+    # Exit through the clean up code, so that a running pipeline is stopped and
+    # our scheduler slot is given back.
+    sys.exit(128 + signum)
+
+def run_worker(queue_dir, exit_when_empty=False, poll=10, max_jobs=None,
+        scheduler_dir=None, run=None):
+    """
+    Claim and run items (only those of `run`, if given) from the queue until 
+    it is empty (if requested) or forever. Each item is run in a slot of this node's scheduler, so that the
+    node's limit on concurrent pipelines holds for queue work as well.
+    """
+    signal.signal(signal.SIGTERM, terminate)
+    queue = WorkQueue(queue_dir)
+    while True:
+        item = queue.claim(run)
+        if item is None:
+            if exit_when_empty:
+                return 0
+            time.sleep(poll)
+            continue
+
+        sys.stderr.write('Running work item {}.\n'.format(item['name']))
+        sys.stderr.flush()
+
+        # Keep our claim fresh while the pipeline runs.
+        finished = threading.Event()
+        def beat():
+            while not finished.wait(queue.lease / 4.0):
+                queue.heartbeat(item['name'])
+        heart = threading.Thread(target=beat)
+        heart.daemon = True
+        heart.start()
+        scheduler = Scheduler(item.get('run', item['name']), 
+            state_dir=scheduler_dir, max_jobs=max_jobs)
+        try:
+            returncode, stdout, stderr, attempts = run_with_retries(
+                item['cmd'],
+                timeout=item['timeout'],
+                retries=item['retries'],
+                backoff=item['backoff'],
+                slot=lambda: scheduler.slot(item['name'], 
+                    slots=item.get('slots', 1))
+            )
+        except OSError as err:
+            returncode, stdout, stderr, attempts = 1, '', str(err), 1
+        finally:
+            finished.set()
+            heart.join()
+        queue.complete(item, returncode, decode(stdout), decode(stderr),
+            attempts)
+
+if __name__ == '__main__':
+    args = get_args()
+    sys.exit(run_worker(args.queue_dir, args.exit_when_empty, args.poll,
+        args.max_jobs, args.scheduler_dir, args.run))